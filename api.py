@@ -0,0 +1,339 @@
+"""JSON read API (/api/v1) for timelines, user messages, likes and follows.
+
+Queries select only the columns the API returns, so no ORM objects are
+built. Pages are keyset-paginated: every JSON response carries the
+`next_cursor` to pass back as `?before=`. With `Accept: application/x-ndjson`
+(or `?format=ndjson`) the endpoint instead streams every remaining row, one
+JSON object per line, fetching API_STREAM_BATCH rows at a time.
+
+Responses are encoded with orjson when it is installed, with the standard
+library otherwise.
+
+The statement builders below are shared with asgi.py, which serves the same
+endpoints on an async engine.
+"""
+
+import json
+
+from flask import Blueprint, Response, current_app, g, request, stream_with_context
+from sqlalchemy import exists, or_, select, true
+
+from libs.pagination import Cursor, before, page_args, parse_id
+from libs.replicas import read_replica
+from models import db, Follows, Likes, Message, TimelineEntry, User
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NDJSON = 'application/x-ndjson'
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MESSAGE_COLUMNS = (Message.id, Message.text, Message.timestamp, Message.likes_count,
+                   Message.user_id, User.username, User.image_url)
+USER_COLUMNS = (User.id, User.username, User.image_url, User.bio)
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=_default).encode()
+
+
+def _default(value):
+    # datetimes, formatted like orjson does for naive values
+    return value.isoformat()
+
+
+def serialize_message(row, liked_ids):
+    return {
+        'id': row.id,
+        'text': row.text,
+        'timestamp': row.timestamp,
+        'likes_count': row.likes_count,
+        'user': {'id': row.user_id, 'username': row.username, 'image_url': row.image_url},
+        'liked': row.id in liked_ids,
+    }
+
+
+def serialize_user(row, following_ids):
+    return {
+        'id': row.id,
+        'username': row.username,
+        'image_url': row.image_url,
+        'bio': row.bio,
+        'following': row.id in following_ids,
+    }
+
+
+def error(message, status):
+    return Response(dumps({'error': message}), status, mimetype='application/json')
+
+
+##############################################################################
+# Statements: each selects up to `limit` rows after `cursor`, leaving out
+# users in `hidden` (blocked by or blocking the viewer, see libs/block_filter.py)
+
+
+def not_hidden(column, hidden):
+    return column.notin_(hidden) if hidden else true()
+
+
+def timeline_statements(user_id, limit, cursor, hidden=frozenset()):
+    '''The pushed and pulled halves of a home timeline page; see `merge_timeline`.'''
+
+    pushed = (select(*MESSAGE_COLUMNS)
+              .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+              .join(User, User.id == Message.user_id)
+              .where(TimelineEntry.user_id == user_id,
+                     not_hidden(TimelineEntry.author_id, hidden),
+                     before(TimelineEntry.timestamp, TimelineEntry.message_id, cursor))
+              .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.message_id.desc())
+              .limit(limit))
+
+    # authors too popular to fan out are merged in at read time, as on /
+    pull_authors = (select(Follows.user_being_followed_id)
+                    .join(User, User.id == Follows.user_being_followed_id)
+                    .where(Follows.user_following_id == user_id,
+                           User.timeline_pull.is_(True)))
+    pulled = (select(*MESSAGE_COLUMNS)
+              .join(User, User.id == Message.user_id)
+              .where(Message.user_id.in_(pull_authors),
+                     not_hidden(Message.user_id, hidden),
+                     before(Message.timestamp, Message.id, cursor))
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(limit))
+    return pushed, pulled
+
+
+def merge_timeline(pushed_rows, pulled_rows, limit):
+    if not pulled_rows:
+        return pushed_rows
+    merged = {row.id: row for row in pushed_rows + pulled_rows}
+    return sorted(merged.values(), key=lambda row: (row.timestamp, row.id), reverse=True)[:limit]
+
+
+def user_messages_statement(user_id, limit, cursor):
+    return (select(*MESSAGE_COLUMNS)
+            .join(User, User.id == Message.user_id)
+            .where(Message.user_id == user_id,
+                   before(Message.timestamp, Message.id, cursor))
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit))
+
+
+def likes_statement(user_id, viewer_id, limit, cursor, hidden=frozenset()):
+    '''Liked messages, most recently liked first; the cursor is a like id.'''
+
+    followed = select(Follows.user_being_followed_id).where(
+        Follows.user_following_id == viewer_id)
+    stmt = (select(*MESSAGE_COLUMNS, Likes.id.label('like_id'))
+            .join(Likes, Likes.message_id == Message.id)
+            .join(User, User.id == Message.user_id)
+            .where(Likes.user_id == user_id,
+                   not_hidden(Message.user_id, hidden),
+                   or_(User.is_private.is_(False),
+                       Message.user_id == viewer_id,
+                       Message.user_id.in_(followed)))
+            .order_by(Likes.id.desc())
+            .limit(limit))
+    if cursor is not None:
+        stmt = stmt.where(Likes.id < cursor)
+    return stmt
+
+
+def follows_statement(user_id, direction, limit, cursor, hidden=frozenset()):
+    '''Followers of `user_id` or accounts it follows, by ascending user id.'''
+
+    if direction == 'followers':
+        listed, owner = Follows.user_following_id, Follows.user_being_followed_id
+    else:
+        listed, owner = Follows.user_being_followed_id, Follows.user_following_id
+    stmt = (select(*USER_COLUMNS)
+            .join(Follows, listed == User.id)
+            .where(owner == user_id, not_hidden(User.id, hidden))
+            .order_by(User.id)
+            .limit(limit))
+    if cursor is not None:
+        stmt = stmt.where(User.id > cursor)
+    return stmt
+
+
+def liked_statement(viewer_id, message_ids):
+    return select(Likes.message_id).where(Likes.user_id == viewer_id,
+                                          Likes.message_id.in_(message_ids))
+
+
+def followed_statement(viewer_id, user_ids):
+    return select(Follows.user_being_followed_id).where(
+        Follows.user_following_id == viewer_id,
+        Follows.user_being_followed_id.in_(user_ids))
+
+
+def privacy_statement(user_id):
+    return select(User.id, User.is_private).where(User.id == user_id)
+
+
+def follows_exists_statement(viewer_id, user_id):
+    return select(exists().where(Follows.user_following_id == viewer_id,
+                                 Follows.user_being_followed_id == user_id))
+
+
+def decode_id_cursor(value):
+    return parse_id(value) if value else None
+
+
+def encode_position(value):
+    return value.encode() if isinstance(value, Cursor) else str(value)
+
+
+def message_position(row):
+    return Cursor(row.timestamp, row.id)
+
+
+def like_position(row):
+    return row.like_id
+
+
+def user_position(row):
+    return row.id
+
+
+##############################################################################
+# Responses
+
+
+def wants_ndjson(args, accept):
+    return args.get('format') == 'ndjson' or accept.best == NDJSON
+
+
+def render_messages(rows):
+    liked = set()
+    if g.viewer.user_id is not None and rows:
+        liked = set(db.session.scalars(
+            liked_statement(g.viewer.user_id, [row.id for row in rows])))
+    return [serialize_message(row, liked) for row in rows]
+
+
+def render_users(rows):
+    following = set()
+    if g.viewer.user_id is not None and rows:
+        following = set(db.session.scalars(
+            followed_statement(g.viewer.user_id, [row.id for row in rows])))
+    return [serialize_user(row, following) for row in rows]
+
+
+def respond(fetch, cursor, position, render):
+    '''A JSON page from `fetch(limit, cursor)`, or an NDJSON stream of all rows.
+
+    `position(row)` is the cursor a following fetch starts after (a `Cursor`
+    or a plain id) and `render(rows)` turns a batch into dicts.
+    '''
+
+    if wants_ndjson(request.args, request.accept_mimetypes):
+        batch = current_app.config['API_STREAM_BATCH']
+
+        def stream(cursor):
+            while True:
+                rows = fetch(batch, cursor)
+                yield b''.join(dumps(item) + b'\n' for item in render(rows))
+                if len(rows) < batch:
+                    return
+                cursor = position(rows[-1])
+
+        return Response(stream_with_context(stream(cursor)), mimetype=NDJSON)
+
+    _, limit = page_args()
+    rows = fetch(limit + 1, cursor)
+    page = rows[:limit]
+    return Response(dumps({
+        'items': render(page),
+        'next_cursor': encode_position(position(page[-1])) if len(rows) > limit else None,
+    }), mimetype='application/json')
+
+
+def visible_user(user_id):
+    '''The user whose data is requested, or an error response.
+
+    Users the viewer blocked or is blocked by look like they don't exist.
+    '''
+
+    user = db.session.execute(privacy_statement(user_id)).first()
+    if user is None or user.id in g.viewer.hidden_ids:
+        return None, error('user not found', 404)
+    viewer_id = g.viewer.user_id
+    if user.is_private and viewer_id != user.id and not (
+            viewer_id is not None
+            and db.session.scalar(follows_exists_statement(viewer_id, user.id))):
+        return None, error('this account is private', 403)
+    return user, None
+
+
+##############################################################################
+# Endpoints
+
+
+@api.route('/timeline')
+@read_replica()
+def timeline():
+    """Home timeline of the logged in user."""
+
+    user_id = g.viewer.user_id
+    if user_id is None:
+        return error('login required', 401)
+
+    def fetch(limit, cursor):
+        pushed, pulled = timeline_statements(user_id, limit, cursor, g.viewer.hidden_ids)
+        return merge_timeline(db.session.execute(pushed).all(),
+                              db.session.execute(pulled).all(), limit)
+
+    return respond(fetch, Cursor.decode(request.args.get('before')),
+                   message_position, render_messages)
+
+
+@api.route('/users/<int:user_id>/messages')
+@read_replica()
+def user_messages(user_id):
+    """Messages posted by a user."""
+
+    user, failure = visible_user(user_id)
+    if failure:
+        return failure
+    return respond(
+        lambda limit, cursor: db.session.execute(
+            user_messages_statement(user.id, limit, cursor)).all(),
+        Cursor.decode(request.args.get('before')), message_position, render_messages)
+
+
+@api.route('/users/<int:user_id>/likes')
+@read_replica()
+def user_likes(user_id):
+    """Messages a user has liked, hiding private authors the viewer can't see."""
+
+    user, failure = visible_user(user_id)
+    if failure:
+        return failure
+    return respond(
+        lambda limit, cursor: db.session.execute(
+            likes_statement(user.id, g.viewer.user_id, limit, cursor,
+                            g.viewer.hidden_ids)).all(),
+        decode_id_cursor(request.args.get('before')), like_position, render_messages)
+
+
+@api.route('/users/<int:user_id>/<any(followers, following):direction>')
+@read_replica()
+def user_follows(user_id, direction):
+    """Followers of a user, or the accounts they follow; logged-in viewers only."""
+
+    if g.viewer.user_id is None:
+        return error('login required', 401)
+    user, failure = visible_user(user_id)
+    if failure:
+        return failure
+    return respond(
+        lambda limit, cursor: db.session.execute(
+            follows_statement(user.id, direction, limit, cursor,
+                              g.viewer.hidden_ids)).all(),
+        decode_id_cursor(request.args.get('before')), user_position, render_users)
@@ -1,20 +1,56 @@
 from datetime import datetime, timedelta
 import os
+import time
 import bcrypt
+import click
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+from flask import Flask, abort, render_template, request, flash, redirect, session, g, url_for, has_request_context, jsonify
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError, DatabaseError
-from sqlalchemy import or_
-from auth import auth
+from sqlalchemy import inspect, or_, select
+from auth import auth, admin
+from api import api
 from forms import ChangePasswordForm, ProfileForm, UserAddForm, LoginForm, MessageForm
 from libs.time_relative import get_age
-from models import db, connect_db, User, Message
+from libs.pagination import page_args, paginate
+from libs.viewer import ViewerContext
+from libs.user_snapshot import forget_user, load_snapshot, profile_versions, remember_user
+from libs.credentials import VerifierSaturated
+from libs.search import search_messages
+from libs.username_index import prefix_pattern, username_index
+from libs.query_stats import init_query_stats
+from libs.metrics import init_metrics
+from libs.replicas import init_engines, read_replica
+from libs.profiler import profiler
+from libs.fragment_cache import fragment_cache
+from libs.like_counter import like_counter
+from libs.block_filter import block_filter
+from libs.assets import assets
+from libs.http_cache import init_http_cache, message_state, not_modified, user_state
+from models import db, connect_db, Follows, FollowRequest, Likes, User, Message, TimelineEntry
 from seed import seed
 
 CURR_USER_KEY = "curr_user"
 
+
+class WarblerGlobals(_AppCtxGlobals):
+    """Flask `g` that loads the logged in user on first access to `g.user`.
+
+    Pages that only need the nav bar data use `g.me` (a session snapshot,
+    checked against the user's `profile_version`) and never load the row.
+    """
+
+    def __getattr__(self, name):
+        if name != 'user':
+            return super().__getattr__(name)
+        user_id = session.get(CURR_USER_KEY) if has_request_context() else None
+        self.user = db.session.get(User, user_id) if user_id is not None else None
+        return self.user
+
+
 app = Flask(__name__)
+app.app_ctx_globals_class = WarblerGlobals
 
 # Get DB_URI from environ variable (useful for production/testing) or,
 # if not set there, use development local db.
@@ -22,14 +58,104 @@ ENV = os.getenv('ENV', 'DEV')
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
+# read replicas (comma separated URIs); see libs/replicas.py
+app.config['SQLALCHEMY_REPLICA_URIS'] = list(filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(',')))
+# seconds a client keeps reading from the primary after a write
+app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# connection pool of every server database engine (primary and replicas)
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
 app.config['SQLALCHEMY_ECHO'] = bool(os.environ.get('SQLALCHEMY_ECHO', False))
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+# bcrypt work factor for new hashes; older hashes are upgraded on login
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# password checks allowed to run / wait at once before logins get a 503
+app.config['CREDENTIAL_WORKERS'] = int(os.environ.get('CREDENTIAL_WORKERS', 2))
+app.config['CREDENTIAL_QUEUE_SIZE'] = int(os.environ.get('CREDENTIAL_QUEUE_SIZE', 4))
+# request threads per worker process (gunicorn.conf.py); password checks are
+# capped below it
+app.config['REQUEST_THREADS'] = int(os.environ.get('GUNICORN_THREADS', 8))
+# authors with at least this many followers are not fanned out on write
+app.config['TIMELINE_FANOUT_LIMIT'] = int(os.environ.get('TIMELINE_FANOUT_LIMIT', 10000))
+# default and maximum number of messages per timeline page
+app.config['PAGE_SIZE'] = int(os.environ.get('PAGE_SIZE', 100))
+app.config['MAX_PAGE_SIZE'] = int(os.environ.get('MAX_PAGE_SIZE', 100))
+# ranked search results are paged with OFFSET, so cap how deep that goes
+app.config['MAX_SEARCH_PAGES'] = int(os.environ.get('MAX_SEARCH_PAGES', 20))
 if ENV == 'DEV':
     toolbar = DebugToolbarExtension(app)
 
+# requests running more SQL statements than this are logged as warnings
+app.config['QUERY_WARN_THRESHOLD'] = int(os.environ.get('QUERY_WARN_THRESHOLD', 50))
+
+# seconds a worker trusts its last read of a user's profile_version; profile
+# edits and deletions from other workers show up in the nav bar after this
+app.config['SNAPSHOT_CHECK_SECONDS'] = float(os.environ.get('SNAPSHOT_CHECK_SECONDS', 30))
+app.config['SNAPSHOT_CHECK_CACHE_SIZE'] = int(os.environ.get('SNAPSHOT_CHECK_CACHE_SIZE', 10000))
+
+# usernames allowed to use the /admin routes
+app.config['ADMIN_USERNAMES'] = set(filter(None, os.environ.get('ADMIN_USERNAMES', '').split(',')))
+# sampling profiler: off unless PROFILE_DIR is set; profiles the listed
+# endpoints, 1 in PROFILE_SAMPLE_RATE requests and admin-triggered captures
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR')
+app.config['PROFILE_ENDPOINTS'] = set(filter(None, os.environ.get('PROFILE_ENDPOINTS', '').split(',')))
+app.config['PROFILE_SAMPLE_RATE'] = int(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['MAX_PROFILE_CAPTURE_SECONDS'] = 300
+
+# memory bound of the rendered message fragment cache (0 disables it)
+app.config['FRAGMENT_CACHE_BYTES'] = int(os.environ.get('FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024))
+
+# per-message like counts are buffered and written once the oldest pending
+# change is this old or this many messages have pending changes
+app.config['LIKE_FLUSH_SECONDS'] = float(os.environ.get('LIKE_FLUSH_SECONDS', 2))
+app.config['LIKE_FLUSH_SIZE'] = int(os.environ.get('LIKE_FLUSH_SIZE', 500))
+
+# users whose blocked / blocked-by id sets are kept in memory per worker
+app.config['BLOCK_CACHE_SIZE'] = int(os.environ.get('BLOCK_CACHE_SIZE', 10000))
+
+# pending follow requests listed per page on the owner's follow pages
+app.config['FOLLOW_REQUESTS_PAGE_SIZE'] = int(os.environ.get('FOLLOW_REQUESTS_PAGE_SIZE', 20))
+# resolved follow requests older than this are moved to the archive table
+app.config['FOLLOW_REQUEST_ARCHIVE_DAYS'] = int(os.environ.get('FOLLOW_REQUEST_ARCHIVE_DAYS', 30))
+
+# rows fetched per query while streaming NDJSON from the API
+app.config['API_STREAM_BATCH'] = int(os.environ.get('API_STREAM_BATCH', 1000))
+
+# async engine pool used by asgi.py (ignored for SQLite)
+app.config['ASYNC_POOL_SIZE'] = int(os.environ.get('ASYNC_POOL_SIZE', 20))
+app.config['ASYNC_POOL_OVERFLOW'] = int(os.environ.get('ASYNC_POOL_OVERFLOW', 20))
+
+# bearer token Prometheus must send to scrape /metrics (unset: /metrics is off)
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# hard caps on username search results
+app.config['USER_SEARCH_LIMIT'] = int(os.environ.get('USER_SEARCH_LIMIT', 60))
+app.config['TYPEAHEAD_LIMIT'] = int(os.environ.get('TYPEAHEAD_LIMIT', 10))
+
+init_metrics(app)
+init_engines(app)
 connect_db(app)
+init_query_stats(app)
+profiler.init_app(app)
+fragment_cache.init_app(app)
+like_counter.init_app(app)
+block_filter.init_app(app)
+profile_versions.init_app(app)
+init_http_cache(app)
+assets.init_app(app)
+app.register_blueprint(api)
+username_index.init_app(app)
+with app.app_context():
+    # warm the typeahead index at startup when the schema already exists;
+    # otherwise it is built on first use
+    if inspect(db.engine).has_table(User.__tablename__):
+        username_index.warm()
 
 ##############################################################################
 # add custom filter to jinja
@@ -40,6 +166,12 @@ app.jinja_env.filters['get_age'] = get_age
 def prohibit(message):
     return render_template('prohibited.html', message=message), 403
 
+@app.errorhandler(VerifierSaturated)
+def credentials_busy(error):
+    """Too many concurrent password checks: ask the client to retry shortly."""
+
+    return (render_template('busy.html'), 503, {'Retry-After': '5'})
+
 # bind MessageForm to g
 @app.before_request
 def add_message_form_across_requests():
@@ -58,6 +190,7 @@ def change_password():
         user.update_password(form.new_password.data)
         db.session.add(user)
         db.session.commit()
+        remember_user(user)
         flash('Your password has been updated!', 'success')
         return render_template('users/change_password.html', form=form, user=user)
 
@@ -68,20 +201,46 @@ def change_password():
 # User signup/login/logout
 
 
+def read_profile_version(user_id):
+    return db.session.scalar(select(User.profile_version).where(User.id == user_id))
+
+
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add a snapshot of curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-    else:
-        g.user = None
+    The snapshot is checked against the user's `profile_version`, read at most
+    once per SNAPSHOT_CHECK_SECONDS per worker (see `ProfileVersions`); the full
+    `User` row is loaded if the snapshot is stale or the view touches `g.user`.
+    Static files don't depend on the user and skip the check.
+    """
+
+    user_id = session.get(CURR_USER_KEY)
+    g.me = None
+    if request.endpoint == 'static':
+        g.viewer = ViewerContext(None)
+        return
+    if user_id is not None:
+        version = profile_versions.get(user_id, read_profile_version)
+        if version is None:
+            # the account was deleted, possibly from another session
+            do_logout()
+            user_id = None
+    g.viewer = ViewerContext(user_id)
+    if user_id is None:
+        return
+
+    g.me = load_snapshot(user_id, version)
+    if g.me is None and g.user:
+        remember_user(g.user)
+        g.me = load_snapshot(user_id, g.user.profile_version)
 
 
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    remember_user(user)
 
 
 def do_logout():
@@ -89,6 +248,7 @@ def do_logout():
 
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
+    forget_user()
 
 
 @app.route('/signup', methods=["GET", "POST"])
@@ -119,6 +279,8 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        username_index.add(user.id, user.username)
+
         do_login(user)
 
         return redirect("/")
@@ -160,23 +322,43 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@read_replica()
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username prefix.
     """
 
     search = request.args.get('q')
+    limit = app.config['USER_SEARCH_LIMIT']
 
     if not search:
-        users = User.query.all()
+        users = User.query.order_by(User.id).limit(limit).all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-
+        users = (User
+                 .query
+                 .filter(User.username.like(prefix_pattern(search), escape='\\'))
+                 .order_by(User.username)
+                 .limit(limit)
+                 .all())
+
+    g.viewer.load_following(users)
     return render_template('users/index.html', users=users)
 
 
+@app.route('/users/typeahead')
+def users_typeahead():
+    """JSON username suggestions for the prefix in 'q', from the in-memory index."""
+
+    search = request.args.get('q', '').strip()
+    if not search:
+        return jsonify([])
+    matches = username_index.search(search, limit=app.config['TYPEAHEAD_LIMIT'])
+    return jsonify([{'id': id, 'username': username} for id, username in matches])
+
+
 @app.route('/users/<int:user_id>')
+@read_replica()
 def users_show(user_id):
     """Show user profile."""
 
@@ -184,31 +366,82 @@ def users_show(user_id):
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    cursor, limit = page_args()
+    messages, next_cursor = [], None
+    if not g.viewer.hides(user):
+        messages, next_cursor = paginate(
+            Message.for_user(user_id, limit + 1, cursor), limit)
+    g.viewer.load_likes(messages)
+    cached = not_modified(user_state(user), message_state(messages), next_cursor)
+    if cached:
+        return cached
+    return render_template('users/show.html', user=user, messages=messages,
+                           next_cursor=next_cursor)
+
+
+def visible_users(user, users):
+    """`users` listed on `user`'s follow pages, minus anyone blocking or blocked
+    by the viewer; nobody if the viewer and `user` are blocked."""
+
+    if g.viewer.hides(user):
+        return []
+    return [other for other in users if not g.viewer.hides(other)]
+
+
+def follow_requests(user, fetch):
+    """A page of `user`'s pending follow requests from `fetch`
+    (`FollowRequest.received` or `.sent`), starting before ?requests_before=,
+    and the id the next page starts before. Only the owner sees them."""
+
+    if not (g.me and g.me.id == user.id):
+        return [], None
+    limit = app.config['FOLLOW_REQUESTS_PAGE_SIZE']
+    rows = fetch(user.id, limit + 1, request.args.get('requests_before', type=int))
+    return rows[:limit], (rows[limit - 1].id if len(rows) > limit else None)
+
+
+def follow_list_state(user, users, requests):
+    """ETag parts of a followers/following page listing `users` and `requests`."""
+
+    state = [(other.id, other.profile_version, g.viewer.is_following(other)) for other in users]
+    if g.me and g.me.id == user.id:
+        # the owner also sees their follow requests with relative ages
+        return state, [req.id for req in requests], int(time.time() // 60)
+    return state,
 
 
 @app.route('/users/<int:user_id>/following')
+@read_replica()
 @auth()
 def show_following(user_id):
     """Show list of people this user is following."""
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following = visible_users(user, user.following)
+    g.viewer.load_following(following)
+    requests, next_requests = follow_requests(user, FollowRequest.sent)
+    cached = not_modified(user_state(user), follow_list_state(user, following, requests))
+    if cached:
+        return cached
+    return render_template('users/following.html', user=user, following=following,
+                           requests=requests, next_requests=next_requests)
 
 
 @app.route('/users/<int:user_id>/followers')
+@read_replica()
 @auth()
 def users_followers(user_id):
     """Show list of followers of this user."""
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    followers = visible_users(user, user.followers)
+    g.viewer.load_following(followers)
+    requests, next_requests = follow_requests(user, FollowRequest.received)
+    cached = not_modified(user_state(user), follow_list_state(user, followers, requests))
+    if cached:
+        return cached
+    return render_template('users/followers.html', user=user, followers=followers,
+                           requests=requests, next_requests=next_requests)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -227,9 +460,8 @@ def add_follow(follow_id):
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    followed_user = User.query.get_or_404(follow_id)
+    g.user.unfollow(followed_user)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -239,14 +471,15 @@ def stop_following(follow_id):
 def profile():
     """Update profile for current user."""
 
-    user: User = g.get('user')
+    user: User = g.user
     form = ProfileForm(obj=user)
     form_data = form.data
     if form.validate_on_submit():
-        if not User.authenticate(user.username, form_data['password']):
-            data = User.authenticate(user.username, form_data['password'])
+        if not user.check_password(form_data['password']):
             flash("Update profile failed due to incorrect password", "danger")
             return redirect("/")
+        old_username = user.username
+        user.profile_version += 1
         user.username = form_data['username']
         user.email = form_data['email']
         user.image_url = form_data['image_url']
@@ -255,6 +488,8 @@ def profile():
         db.session.is_modified = True
         try:
             db.session.commit()
+            remember_user(user)
+            username_index.rename(user.id, old_username, user.username)
             return redirect(f'/users/{user.id}')
         except DatabaseError:
             db.session.rollback()
@@ -269,30 +504,46 @@ def delete_user():
 
     do_logout()
 
+    Follows.forget_user(g.user.id)
+    Likes.forget_user(g.user.id)
+    FollowRequest.forget_user(g.user.id)
+    username_index.remove(g.user.id, g.user.username)
     db.session.delete(g.user)
     db.session.commit()
+    profile_versions.forget(g.user.id)
 
     return redirect("/signup")
 
 @app.route('/users/add_like/<int:message_id>', methods=['POST'])
 @auth()
 def toggle_like(message_id: int):
-    if message_id in [message.id for message in g.user.likes]:
-        message = [m for m in g.user.likes if m.id == message_id][0]
-        g.user.likes.remove(message)
-        flash(f'You just unlike wrabler #{message.id}', 'info')
+    change = Likes.toggle(g.user.id, message_id)
+    if change is None:
+        abort(404)
+    if change:
+        User.adjust_counts(g.user.id, likes_count=change)
+    db.session.commit()
+    like_counter.add(message_id, change)
 
+    if change < 0:
+        flash(f'You just unlike wrabler #{message_id}', 'info')
     else:
-        message = Message.query.get(message_id)
-        g.user.likes.append(message)
-        flash(f'You just like wrabler #{message.id}', 'success')
-    db.session.commit()
+        flash(f'You just like wrabler #{message_id}', 'success')
     return redirect('/')
 
 @app.route('/users/<int:user_id>/likes')
+@read_replica()
 def users_likes(user_id):
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user, messages=user.likes)
+    messages = []
+    if not g.viewer.hides(user):
+        messages = [message for message in Message.liked_by(user_id)
+                    if message.user_id not in g.viewer.hidden_ids]
+    g.viewer.load_likes(messages)
+    cached = not_modified(user_state(user), message_state(messages))
+    if cached:
+        return cached
+    return render_template('users/likes.html', user=user, messages=messages)
 
 @app.route('/users/<int:user_id>/change-status', methods=["POST"])
 @auth()
@@ -302,7 +553,9 @@ def user_change_status(user_id):
         return prohibit('You can only change your own status.')
     
     user.is_private = request.form.get('is_private', False) in ('y', 'yes', 'True', 'true')
+    user.profile_version += 1
     db.session.commit()
+    remember_user(user)
 
     return redirect(f'/users/{user.id}')
 @app.route('/follow-request/<int:request_id>/cancel', methods=["POST"])
@@ -375,6 +628,9 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        User.adjust_counts(g.user.id, messages_count=1)
+        TimelineEntry.fan_out(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -382,11 +638,38 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Full-text search over messages, best matches first.
+
+    Takes 'q' and an optional 1-based 'page' in the querystring.
+    """
+
+    search = request.args.get('q', '').strip()
+    page = max(1, min(request.args.get('page', 1, type=int),
+                      app.config['MAX_SEARCH_PAGES']))
+    limit = app.config['PAGE_SIZE']
+
+    messages = []
+    if search:
+        messages = search_messages(search, g.viewer.user_id,
+                                   limit=limit + 1, offset=(page - 1) * limit,
+                                   hidden=g.viewer.hidden_ids)
+    has_more = len(messages) > limit and page < app.config['MAX_SEARCH_PAGES']
+    messages = messages[:limit]
+    g.viewer.load_likes(messages)
+    return render_template('messages/search.html', messages=messages,
+                           search=search, page=page, has_more=has_more)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
+    if msg.user_id in g.viewer.hidden_ids:
+        abort(404)
+    g.viewer.load_likes([msg])
     return render_template('messages/show.html', message=msg)
 
 
@@ -395,9 +678,13 @@ def messages_show(message_id):
 def messages_destroy(message_id):
     """Delete a message."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
+    TimelineEntry.remove_message(msg.id)
+    User.adjust_counts(msg.user_id, messages_count=-1)
+    Likes.forget_message(msg.id)
     db.session.delete(msg)
     db.session.commit()
+    fragment_cache.evict(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -407,45 +694,71 @@ def messages_destroy(message_id):
 
 
 @app.route('/')
+@read_replica()
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        following_user_ids = [ user.id for user in g.user.following]
-        following_user_ids.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_user_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        cursor, limit = page_args()
+        messages, next_cursor = paginate(
+            TimelineEntry.home_messages(g.user, limit + 1, cursor, g.viewer.hidden_ids), limit)
+        g.viewer.load_likes(messages)
+        cached = not_modified(message_state(messages), next_cursor)
+        if cached:
+            return cached
 
-        return render_template('home.html', messages=messages)
+        return render_template('home.html', messages=messages,
+                               next_cursor=next_cursor)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Admin
+
+@app.post('/admin/profile')
+@admin()
+def trigger_profile():
+    """Profile every request in every worker for the next `seconds` seconds."""
+
+    if not profiler.directory:
+        return jsonify(error='profiling is disabled; set PROFILE_DIR'), 409
+    seconds = min(request.form.get('seconds', 30, type=int),
+                  app.config['MAX_PROFILE_CAPTURE_SECONDS'])
+    until = profiler.trigger(seconds)
+    return jsonify(directory=profiler.directory,
+                   until=datetime.utcfromtimestamp(until).isoformat(timespec='seconds'))
+
+##############################################################################
+# Maintenance commands
+
+@app.cli.command('reconcile-counts')
+def reconcile_counts_command():
+    """Recompute the denormalized counters of every user and message."""
+
+    like_counter.flush()
+    User.reconcile_counts()
+    Message.reconcile_likes()
+    db.session.commit()
+    print('Counters reconciled.')
+
+
+@app.cli.command('archive-follow-requests')
+@click.option('--days', type=int, default=None,
+              help='Archive requests resolved more than this many days ago '
+                   '(default: FOLLOW_REQUEST_ARCHIVE_DAYS).')
+def archive_follow_requests_command(days):
+    """Move old accepted, denied and canceled follow requests to the archive."""
+
+    if days is None:
+        days = app.config['FOLLOW_REQUEST_ARCHIVE_DAYS']
+    moved = FollowRequest.archive_resolved(datetime.utcnow() - timedelta(days=days))
+    print(f'Archived {moved} follow requests.')
 
 ##############################################################################
 # Secret route for seeding
@@ -457,5 +770,12 @@ def seed_route():
     is_valid = bcrypt.checkpw(password.encode('utf-8'), PW)
 
     if is_valid:
+        like_counter.flush()
         seed()
+        # the new dataset reuses ids and starts the versions over, so entries
+        # cached for the old one would look current
+        fragment_cache.clear()
+        block_filter.clear()
+        profile_versions.clear()
+        username_index.warm()
     return 'OK', 200
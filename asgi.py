@@ -0,0 +1,310 @@
+"""ASGI entry point: async JSON reads, everything else through Flask.
+
+    uvicorn asgi:application --workers 2
+    # or, keeping gunicorn.conf.py's metrics hooks:
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker -w 2 asgi:application
+
+GET requests to the /api/v1 read endpoints (timeline, user messages, likes,
+followers/following) run on an async SQLAlchemy engine (asyncpg for
+PostgreSQL, aiosqlite for SQLite), so a slow database round trip suspends a
+coroutine instead of holding a worker. They reuse api.py's statements and
+serializers, so both serving modes return the same documents. Every other
+request (HTML pages, forms, writes) goes to the Flask app through asgiref's
+WsgiToAsgi, which runs it on a thread pool.
+
+With read replicas configured the async reads are spread over them too,
+honouring the same read-your-writes window as @read_replica views.
+"""
+
+import random
+import re
+import time
+from http.cookies import CookieError, SimpleCookie
+from typing import NamedTuple, Optional
+from urllib.parse import parse_qsl
+
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import api
+from app import app, CURR_USER_KEY
+from libs.block_filter import EMPTY, BlockFilter, block_filter
+from libs.metrics import IN_FLIGHT, REQUEST_LATENCY, REQUESTS
+from libs.pagination import Cursor
+from libs.replicas import reads_from_primary
+from models import User
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'cockroachdb': 'cockroachdb+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_url(uri):
+    '''The async-driver version of a SQLAlchemy database URI.'''
+
+    url = make_url(uri)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+class AsyncRequest(NamedTuple):
+    args: dict
+    accept: MIMEAccept
+    viewer_id: Optional[int]
+    primary: bool
+
+
+class AsyncReads:
+    '''ASGI app serving the API reads itself and passing the rest to Flask.'''
+
+    def __init__(self, flask_app, engine=None, replicas=None):
+        self.flask_app = flask_app
+        self.config = flask_app.config
+        self.engine = engine or self.create_engine(self.config['SQLALCHEMY_DATABASE_URI'])
+        if replicas is None:
+            replicas = [self.create_engine(uri) for uri in self.config['SQLALCHEMY_REPLICA_URIS']]
+        self.replicas = replicas
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.routes = [
+            (re.compile(r'/api/v1/timeline'), 'api.timeline', self.timeline),
+            (re.compile(r'/api/v1/users/(?P<user_id>\d+)/messages'), 'api.user_messages',
+             self.user_messages),
+            (re.compile(r'/api/v1/users/(?P<user_id>\d+)/likes'), 'api.user_likes',
+             self.user_likes),
+            (re.compile(r'/api/v1/users/(?P<user_id>\d+)/(?P<direction>followers|following)'),
+             'api.user_follows', self.user_follows),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            for pattern, endpoint, handler in self.routes:
+                match = pattern.fullmatch(scope['path'])
+                if match:
+                    return await self.dispatch(scope, send, endpoint, handler, match.groupdict())
+        await self.wsgi(scope, receive, send)
+
+    def create_engine(self, uri):
+        url = async_url(uri)
+        options = {}
+        if url.get_backend_name() != 'sqlite':
+            options = {'pool_size': self.config['ASYNC_POOL_SIZE'],
+                       'max_overflow': self.config['ASYNC_POOL_OVERFLOW'],
+                       'pool_recycle': self.config['DB_POOL_RECYCLE'],
+                       'pool_pre_ping': self.config['DB_POOL_PRE_PING']}
+        return create_async_engine(url, **options)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for engine in [self.engine, *self.replicas]:
+                    await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, scope, send, endpoint, handler, params):
+        started = time.perf_counter()
+        IN_FLIGHT.inc()
+        status = 500
+        try:
+            request = self.request(scope)
+            engine = self.engine
+            if self.replicas and not request.primary:
+                engine = random.choice(self.replicas)
+            async with engine.connect() as conn:
+                status = await handler(conn, send, request, **params)
+        finally:
+            IN_FLIGHT.dec()
+            REQUEST_LATENCY.labels(endpoint).observe(time.perf_counter() - started)
+            REQUESTS.labels(endpoint, 'GET', str(status)).inc()
+
+    def request(self, scope):
+        headers = dict(scope['headers'])
+        args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+        accept = parse_accept_header(headers.get(b'accept', b'').decode('latin-1'), MIMEAccept)
+        session = self.session(headers.get(b'cookie'))
+        return AsyncRequest(args, accept, session.get(CURR_USER_KEY), reads_from_primary(session))
+
+    def session(self, cookie_header):
+        '''The contents of Flask's signed session cookie, if any.'''
+
+        if not cookie_header:
+            return {}
+        try:
+            cookie = SimpleCookie(cookie_header.decode('latin-1'))
+        except CookieError:
+            return {}
+        morsel = cookie.get(self.config['SESSION_COOKIE_NAME'])
+        if morsel is None:
+            return {}
+        serializer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+        max_age = int(self.flask_app.permanent_session_lifetime.total_seconds())
+        try:
+            return serializer.loads(morsel.value, max_age=max_age)
+        except BadSignature:
+            return {}
+
+    ##########################################################################
+    # Responses
+
+    async def send_json(self, send, status, value):
+        body = api.dumps(value)
+        await send({'type': 'http.response.start', 'status': status, 'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ]})
+        await send({'type': 'http.response.body', 'body': body})
+        return status
+
+    async def respond(self, send, request, fetch, cursor, position, render):
+        '''Async twin of `api.respond`.'''
+
+        if api.wants_ndjson(request.args, request.accept):
+            batch = self.config['API_STREAM_BATCH']
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', api.NDJSON.encode())]})
+            while True:
+                rows = await fetch(batch, cursor)
+                body = b''.join(api.dumps(item) + b'\n' for item in await render(rows))
+                more = len(rows) == batch
+                await send({'type': 'http.response.body', 'body': body, 'more_body': more})
+                if not more:
+                    return 200
+                cursor = position(rows[-1])
+
+        try:
+            limit = int(request.args.get('limit', self.config['PAGE_SIZE']))
+        except ValueError:
+            limit = self.config['PAGE_SIZE']
+        limit = max(1, min(limit, self.config['MAX_PAGE_SIZE']))
+        rows = await fetch(limit + 1, cursor)
+        page = rows[:limit]
+        return await self.send_json(send, 200, {
+            'items': await render(page),
+            'next_cursor': api.encode_position(position(page[-1])) if len(rows) > limit else None,
+        })
+
+    async def hidden_ids(self, conn, viewer_id):
+        '''Ids the viewer blocked or is blocked by, through the shared block cache.'''
+
+        if viewer_id is None:
+            return EMPTY.hidden
+        version = await conn.scalar(
+            select(User.relations_version).where(User.id == viewer_id))
+        if version is None:
+            return EMPTY.hidden
+        blocks = block_filter.cached(viewer_id, version)
+        if blocks is None:
+            rows = await conn.execute(BlockFilter.statement(viewer_id))
+            blocks = block_filter.store(viewer_id, version, BlockFilter.from_rows(rows))
+        return blocks.hidden
+
+    async def visibility_error(self, conn, send, request, user_id, hidden):
+        '''None if the viewer may read `user_id`'s data; else sends the error and returns its status.'''
+
+        user = (await conn.execute(api.privacy_statement(user_id))).first()
+        if user is None or user.id in hidden:
+            return await self.send_json(send, 404, {'error': 'user not found'})
+        viewer_id = request.viewer_id
+        if user.is_private and viewer_id != user.id and not (
+                viewer_id is not None
+                and await conn.scalar(api.follows_exists_statement(viewer_id, user.id))):
+            return await self.send_json(send, 403, {'error': 'this account is private'})
+        return None
+
+    def message_renderer(self, conn, viewer_id):
+        async def render(rows):
+            liked = set()
+            if viewer_id is not None and rows:
+                liked = set(await conn.scalars(
+                    api.liked_statement(viewer_id, [row.id for row in rows])))
+            return [api.serialize_message(row, liked) for row in rows]
+        return render
+
+    def user_renderer(self, conn, viewer_id):
+        async def render(rows):
+            following = set()
+            if viewer_id is not None and rows:
+                following = set(await conn.scalars(
+                    api.followed_statement(viewer_id, [row.id for row in rows])))
+            return [api.serialize_user(row, following) for row in rows]
+        return render
+
+    ##########################################################################
+    # Endpoints (see api.py for the sync versions)
+
+    async def timeline(self, conn, send, request):
+        user_id = request.viewer_id
+        if user_id is None:
+            return await self.send_json(send, 401, {'error': 'login required'})
+
+        hidden = await self.hidden_ids(conn, user_id)
+
+        async def fetch(limit, cursor):
+            pushed, pulled = api.timeline_statements(user_id, limit, cursor, hidden)
+            return api.merge_timeline((await conn.execute(pushed)).all(),
+                                      (await conn.execute(pulled)).all(), limit)
+
+        return await self.respond(send, request, fetch, Cursor.decode(request.args.get('before')),
+                                  api.message_position, self.message_renderer(conn, user_id))
+
+    async def user_messages(self, conn, send, request, user_id):
+        user_id = int(user_id)
+        hidden = await self.hidden_ids(conn, request.viewer_id)
+        failure = await self.visibility_error(conn, send, request, user_id, hidden)
+        if failure:
+            return failure
+
+        async def fetch(limit, cursor):
+            return (await conn.execute(api.user_messages_statement(user_id, limit, cursor))).all()
+
+        return await self.respond(send, request, fetch, Cursor.decode(request.args.get('before')),
+                                  api.message_position,
+                                  self.message_renderer(conn, request.viewer_id))
+
+    async def user_likes(self, conn, send, request, user_id):
+        user_id = int(user_id)
+        hidden = await self.hidden_ids(conn, request.viewer_id)
+        failure = await self.visibility_error(conn, send, request, user_id, hidden)
+        if failure:
+            return failure
+
+        async def fetch(limit, cursor):
+            return (await conn.execute(
+                api.likes_statement(user_id, request.viewer_id, limit, cursor, hidden))).all()
+
+        return await self.respond(send, request, fetch,
+                                  api.decode_id_cursor(request.args.get('before')),
+                                  api.like_position,
+                                  self.message_renderer(conn, request.viewer_id))
+
+    async def user_follows(self, conn, send, request, user_id, direction):
+        if request.viewer_id is None:
+            return await self.send_json(send, 401, {'error': 'login required'})
+        user_id = int(user_id)
+        hidden = await self.hidden_ids(conn, request.viewer_id)
+        failure = await self.visibility_error(conn, send, request, user_id, hidden)
+        if failure:
+            return failure
+
+        async def fetch(limit, cursor):
+            return (await conn.execute(
+                api.follows_statement(user_id, direction, limit, cursor, hidden))).all()
+
+        return await self.respond(send, request, fetch,
+                                  api.decode_id_cursor(request.args.get('before')),
+                                  api.user_position,
+                                  self.user_renderer(conn, request.viewer_id))
+
+
+application = AsyncReads(app)
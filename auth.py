@@ -1,5 +1,5 @@
 from typing import Callable
-from flask import render_template, g, make_response
+from flask import render_template, g, make_response, current_app
 
 def auth():
   def wrapper(func: Callable):
@@ -9,4 +9,17 @@ def auth():
       return func(*args, **kwargs)
     handler.__name__ = func.__name__
     return handler
-  return wrapper
\ No newline at end of file
+  return wrapper
+
+def admin():
+  '''Only users listed in ADMIN_USERNAMES may call the view; others get a 403.'''
+  def wrapper(func: Callable):
+    def handler(*args, **kwargs):
+      if not g.user:
+        return make_response(render_template('unauthorized.html'), 401)
+      if g.user.username not in current_app.config['ADMIN_USERNAMES']:
+        return make_response(render_template('prohibited.html'), 403)
+      return func(*args, **kwargs)
+    handler.__name__ = func.__name__
+    return handler
+  return wrapper
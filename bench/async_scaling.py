@@ -0,0 +1,153 @@
+"""Sync (gunicorn) vs async (uvicorn + asgi.py) throughput under a slow database.
+
+Seeds a SQLite dataset, starts both servers on it with the same number of
+worker processes and the same simulated per-statement latency
+(bench/slow_db.py), then drives the async-served API reads (timeline, user
+messages, followers) at increasing concurrency and reports throughput and
+latency percentiles for each.
+
+    python bench/async_scaling.py --delay-ms 20 --concurrency 1 8 32 64
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+
+import requests
+
+from loadtest import ROOT, percentile, prepare_dataset
+
+SERVERS = {
+    'sync': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', '--chdir', ROOT, '-w', str(workers),
+        '-b', f'127.0.0.1:{port}', '--timeout', '0', 'bench.slow_db:app'],
+    'async': lambda port, workers: [
+        sys.executable, '-m', 'uvicorn', '--app-dir', ROOT, '--workers', str(workers),
+        '--port', str(port), '--log-level', 'warning', 'bench.slow_db:application'],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, workers, env):
+    port = free_port()
+    process = subprocess.Popen(SERVERS[mode](port, workers), cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    for _ in range(300):
+        try:
+            requests.get(base + '/login', timeout=5)
+            return process, base
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"{mode} server did not start")
+
+
+def request_plan(count, users, cookies, rng):
+    for _ in range(count):
+        user, other = rng.randint(1, users), rng.randint(1, users)
+        path = rng.choice(['/api/v1/timeline', f'/api/v1/users/{other}/messages',
+                           f'/api/v1/users/{other}/followers'])
+        yield path, cookies[user]
+
+
+def drive(base, plan, concurrency):
+    local = threading.local()
+    latencies, errors = [], []
+
+    def send(item):
+        path, cookie = item
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        response = local.session.get(base + path, headers={'Cookie': f'session={cookie}'})
+        latencies.append(time.perf_counter() - started)
+        if response.status_code >= 500:
+            errors.append(response.status_code)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, plan))
+    duration = time.perf_counter() - started
+
+    latencies = sorted(elapsed * 1000 for elapsed in latencies)
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput_rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--follows', type=int, default=10000)
+    parser.add_argument('--data-dir', help="reuse generated CSVs instead of generating")
+    parser.add_argument('--delay-ms', type=float, default=20,
+                        help="simulated latency of every SQL statement")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 64])
+    parser.add_argument('--requests', type=int, default=400, help="requests per level")
+    parser.add_argument('--modes', nargs='+', default=list(SERVERS), choices=list(SERVERS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="write the results as JSON")
+    options = parser.parse_args()
+
+    database = f"sqlite:///{tempfile.mkdtemp(prefix='warbler-async-')}/warbler.db"
+    os.environ['DATABASE_URL'] = database
+    os.environ.setdefault('ENV', 'BENCH')
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    app, _, users, _ = prepare_dataset(options)
+
+    from app import CURR_USER_KEY
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookies = {user: serializer.dumps({CURR_USER_KEY: user}) for user in range(1, users + 1)}
+
+    env = dict(os.environ, DATABASE_URL=database, BENCH_DB_DELAY_MS=str(options.delay_ms))
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    results = {}
+    for mode in options.modes:
+        process, base = start_server(mode, options.workers, env)
+        try:
+            results[mode] = {}
+            for concurrency in options.concurrency:
+                plan = list(request_plan(options.requests, users, cookies, Random(options.seed)))
+                drive(base, plan[:concurrency * 2], concurrency)  # warm up connections
+                results[mode][concurrency] = drive(base, plan, concurrency)
+        finally:
+            process.terminate()
+            process.wait()
+
+    print(f"{options.delay_ms:g} ms per statement, {options.workers} workers")
+    print(f"{'mode':<8}{'conc':>6}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'err':>6}")
+    for mode, levels in results.items():
+        for concurrency, stats in levels.items():
+            print(f"{mode:<8}{concurrency:>6}{stats['throughput_rps']:>10.1f}"
+                  f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+                  f"{stats['errors']:>6}")
+    if options.out:
+        with open(options.out, 'w') as output:
+            json.dump({'delay_ms': options.delay_ms, 'workers': options.workers,
+                       'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""Route-level load benchmark for Warbler.
+
+Builds (or reuses) a generated dataset, seeds a database with it, then replays
+a request mix against the app and reports per-route latency percentiles,
+throughput and SQL statement counts as JSON, so runs can be diffed between
+commits.
+
+    # in-process (WSGI test client) against a fresh 20k-user SQLite dataset
+    python bench/loadtest.py --users 20000 --follows 200000 --messages 100000
+
+    # replay recorded traffic against a local gunicorn
+    python bench/loadtest.py --target http://127.0.0.1:5000 \\
+        --replay bench/profiles/sample-replay.jsonl --cookie "session=..."
+
+    # compare two runs
+    python bench/loadtest.py --compare bench/results/a.json bench/results/b.json
+
+The traffic profile (--profile) is a JSON object whose "mix" maps route names
+(home, profile, followers, likes, like, post) to relative weights. A replay
+file (--replay) holds one request per line:
+{"method": "GET", "path": "/", "user": 1, "data": {...}}.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from random import Random
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PROFILE = os.path.join(ROOT, 'bench', 'profiles', 'default.json')
+RESULTS_DIR = os.path.join(ROOT, 'bench', 'results')
+
+
+##############################################################################
+# Traffic
+
+
+def synthetic_requests(mix, count, users, messages, rng):
+    """`count` requests drawn from the weighted route `mix`."""
+
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+    for route in rng.choices(routes, weights=weights, k=count):
+        user = rng.randint(1, users)
+        other = rng.randint(1, users)
+        if route == 'home':
+            yield {'route': route, 'method': 'GET', 'path': '/', 'user': user}
+        elif route == 'profile':
+            yield {'route': route, 'method': 'GET', 'path': f'/users/{other}', 'user': user}
+        elif route == 'followers':
+            yield {'route': route, 'method': 'GET', 'path': f'/users/{other}/followers', 'user': user}
+        elif route == 'likes':
+            yield {'route': route, 'method': 'GET', 'path': f'/users/{user}/likes', 'user': user}
+        elif route == 'like':
+            message = rng.randint(1, messages)
+            yield {'route': route, 'method': 'POST', 'path': f'/users/add_like/{message}', 'user': user}
+        elif route == 'post':
+            yield {'route': route, 'method': 'POST', 'path': '/messages/new', 'user': user,
+                   'data': {'text': f'benchmark warble {rng.random():.6f}'}}
+        else:
+            raise ValueError(f"unknown route in traffic mix: {route}")
+
+
+def replayed_requests(path):
+    with open(path) as replay:
+        for line in replay:
+            if line.strip():
+                request = json.loads(line)
+                request.setdefault('route', f"{request['method']} {request['path']}")
+                yield request
+
+
+##############################################################################
+# Drivers
+
+
+class InProcessDriver:
+    """Drives the Flask app through its WSGI test client, one client per thread."""
+
+    def __init__(self, app, db):
+        self.app = app
+        self.local = threading.local()
+
+    def send(self, request):
+        from app import CURR_USER_KEY
+
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        client = self.local.client
+        with client.session_transaction() as session:
+            session.clear()
+            if request.get('user'):
+                session[CURR_USER_KEY] = request['user']
+
+        started = time.perf_counter()
+        response = client.open(request['path'], method=request['method'],
+                               data=request.get('data'))
+        elapsed = time.perf_counter() - started
+        return response.status_code, elapsed, int(response.headers['X-DB-Queries'])
+
+
+class HttpDriver:
+    """Sends requests to a running server; users come from the --cookie session."""
+
+    def __init__(self, target, cookie):
+        import requests
+
+        self.target = target.rstrip('/')
+        self.cookie = cookie
+        self.local = threading.local()
+        self.requests = requests
+
+    def send(self, request):
+        if not hasattr(self.local, 'session'):
+            self.local.session = self.requests.Session()
+            if self.cookie:
+                self.local.session.headers['Cookie'] = self.cookie
+        started = time.perf_counter()
+        response = self.local.session.request(
+            request['method'], self.target + request['path'],
+            data=request.get('data'), allow_redirects=False)
+        elapsed = time.perf_counter() - started
+        statements = response.headers.get('X-DB-Queries')
+        return response.status_code, elapsed, int(statements) if statements else None
+
+
+##############################################################################
+# Dataset
+
+
+def prepare_dataset(options):
+    """Generate CSVs unless --data-dir was given, then seed the database."""
+
+    data_dir = options.data_dir
+    if not data_dir:
+        data_dir = tempfile.mkdtemp(prefix='warbler-bench-')
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+             '--users', str(options.users), '--messages', str(options.messages),
+             '--follows', str(options.follows), '--seed', str(options.seed),
+             '--out', data_dir],
+            check=True, stdout=subprocess.DEVNULL)
+
+    from app import app
+    from models import db
+    from seed import seed
+
+    with app.app_context():
+        seed(data_dir)
+        from models import Message, User
+        users = db.session.query(User).count()
+        messages = db.session.query(Message).count()
+    return app, db, users, messages
+
+
+##############################################################################
+# Reporting
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, duration):
+    routes = {}
+    for route, route_samples in sorted(samples.items()):
+        latencies = sorted(elapsed * 1000 for _, elapsed, _ in route_samples)
+        statements = [count for _, _, count in route_samples if count is not None]
+        errors = sum(1 for status, _, _ in route_samples if status >= 500)
+        routes[route] = {
+            'requests': len(route_samples),
+            'errors': errors,
+            'throughput_rps': round(len(route_samples) / duration, 2),
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'mean_ms': round(sum(latencies) / len(latencies), 3),
+            'sql_statements_mean': round(sum(statements) / len(statements), 2) if statements else None,
+            'sql_statements_max': max(statements) if statements else None,
+        }
+    return routes
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result):
+    print(f"{'route':<28}{'reqs':>7}{'err':>5}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'sql':>7}")
+    for route, stats in result['routes'].items():
+        sql = stats['sql_statements_mean']
+        print(f"{route:<28}{stats['requests']:>7}{stats['errors']:>5}"
+              f"{stats['throughput_rps']:>9.1f}{stats['p50_ms']:>9.2f}"
+              f"{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}"
+              f"{sql if sql is not None else '-':>7}")
+    print(f"total: {result['total_requests']} requests in {result['duration_s']:.2f}s "
+          f"({result['throughput_rps']:.1f} req/s)")
+
+
+def compare(before_path, after_path):
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print(f"{before.get('revision')} -> {after.get('revision')}")
+    print(f"{'route':<28}{'p50':>28}{'p95':>28}{'sql':>22}")
+    for route in sorted(set(before['routes']) | set(after['routes'])):
+        old, new = before['routes'].get(route), after['routes'].get(route)
+        if not old or not new:
+            print(f"{route:<28}{'only in ' + ('after' if new else 'before'):>20}")
+            continue
+
+        def delta(key):
+            if old[key] is None or new[key] is None:
+                return '-'
+            change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0
+            return f"{old[key]}->{new[key]} ({change:+.0f}%)"
+
+        print(f"{route:<28}{delta('p50_ms'):>28}{delta('p95_ms'):>28}"
+              f"{delta('sql_statements_mean'):>22}")
+
+
+##############################################################################
+# Main
+
+
+def run(options):
+    rng = Random(options.seed)
+    if options.target:
+        driver = HttpDriver(options.target, options.cookie)
+        users, messages = options.users, options.messages
+    else:
+        os.environ['DATABASE_URL'] = options.database or \
+            f"sqlite:///{tempfile.mkdtemp(prefix='warbler-bench-db-')}/warbler.db"
+        os.environ.setdefault('ENV', 'BENCH')
+        sys.path.insert(0, ROOT)
+        os.chdir(ROOT)
+        app, db, users, messages = prepare_dataset(options)
+        app.config['WTF_CSRF_ENABLED'] = False
+        driver = InProcessDriver(app, db)
+
+    if options.replay:
+        plan = list(replayed_requests(options.replay))
+    else:
+        with open(options.profile) as profile:
+            mix = json.load(profile)['mix']
+        plan = list(synthetic_requests(mix, options.warmup + options.requests,
+                                       users, messages, rng))
+
+    for request in plan[:options.warmup]:
+        driver.send(request)
+    plan = plan[options.warmup:]
+
+    samples = defaultdict(list)
+    lock = threading.Lock()
+
+    def send(request):
+        sample = driver.send(request)
+        with lock:
+            samples[request['route']].append(sample)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as pool:
+        list(pool.map(send, plan))
+    duration = time.perf_counter() - started
+
+    return {
+        'revision': git_revision(),
+        'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'mode': 'http' if options.target else 'in-process',
+        'dataset': {'users': users, 'messages': messages, 'follows': options.follows},
+        'concurrency': options.concurrency,
+        'total_requests': len(plan),
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(plan) / duration, 2),
+        'routes': summarize(samples, duration),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Route-level load benchmark for Warbler.")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=40000)
+    parser.add_argument('--data-dir', help="reuse generated CSVs instead of generating")
+    parser.add_argument('--database', help="database URL (default: a fresh SQLite file)")
+    parser.add_argument('--target', help="base URL of a running server (HTTP mode)")
+    parser.add_argument('--cookie', help="Cookie header to send in HTTP mode")
+    parser.add_argument('--profile', default=DEFAULT_PROFILE, help="traffic mix JSON")
+    parser.add_argument('--replay', help="JSONL file of recorded requests")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="results JSON path (default: bench/results/)")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    options = parser.parse_args()
+
+    if options.compare:
+        compare(*options.compare)
+        return
+
+    result = run(options)
+    print_report(result)
+
+    out = options.out or os.path.join(
+        RESULTS_DIR, f"{result['created_at'].replace(':', '')}-{result['revision'] or 'local'}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'w') as results:
+        json.dump(result, results, indent=2)
+    print(f"results written to {out}")
+
+
+if __name__ == '__main__':
+    main()
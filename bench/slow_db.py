@@ -0,0 +1,36 @@
+"""Server entry points with simulated database latency.
+
+Every SQL statement sleeps BENCH_DB_DELAY_MS inside the database driver, as a
+round trip to a remote database would: pysqlite blocks the calling worker,
+aiosqlite blocks only its connection thread while the event loop carries on.
+Used by async_scaling.py:
+
+    gunicorn --chdir . bench.slow_db:app
+    uvicorn --app-dir . bench.slow_db:application
+"""
+
+import os
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DELAY = float(os.environ.get('BENCH_DB_DELAY_MS', 0)) / 1000
+
+
+def _sleep(statement):
+    time.sleep(DELAY)
+
+
+@event.listens_for(Engine, 'connect')
+def _slow_connection(dbapi_connection, connection_record):
+    if not DELAY:
+        return
+    if hasattr(dbapi_connection, 'await_'):
+        # SQLAlchemy's aiosqlite adapter; the callback runs on aiosqlite's thread
+        dbapi_connection.await_(dbapi_connection._connection.set_trace_callback(_sleep))
+    else:
+        dbapi_connection.set_trace_callback(_sleep)
+
+
+from asgi import app, application  # noqa: E402
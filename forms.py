@@ -51,7 +51,6 @@ class ChangePasswordForm(FlaskForm):
     new_password = PasswordField('New Password', validators=[Length(min=6)])
     retype_password = PasswordField('Retype New Password', validators=[MatchValidator('new_password', 'New password and Retype new password should match'), Length(min=6)])
     def validate_current_password(self, *args, **kwargs):
-        print('VALIDATE PASSWORD')
         user: User = self.user
-        if not user.authenticate(user.username, self.current_password.data):
+        if not user.check_password(self.current_password.data):
             raise ValidationError('Current password is incorrect')
\ No newline at end of file
@@ -3,75 +3,229 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Runs fully offline. Popularity follows a power law: a few users collect most
+followers, likes and posts, while most users follow a handful of accounts.
+Rows are streamed to per-shard part files by a pool of worker processes and
+concatenated at the end; every shard has its own seeded RNG, so the same
+--seed produces the same files whatever --workers is set to.
+
+    python generator/create_csvs.py --users 1000000 --follows 50000000 \\
+        --messages 100000000 --likes 20000000 --workers 8 --out /data/warbler
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+import shutil
+from datetime import datetime
+from functools import lru_cache
+from multiprocessing import Pool
+from random import Random
+
+from faker.providers.lorem.en_US import Provider as LoremProvider
+
+from helpers import Zipf, growing_datetime, pareto_degree
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 0
+
+# rows handled by one task; fixed so output doesn't depend on --workers
+SHARD_SIZE = 100_000
 
-fake = Faker()
+# Zipf exponents for who gets followed / who posts / which posts get liked,
+# and the Pareto exponent of how many accounts a user follows or likes
+FOLLOW_ALPHA = 1.0
+POST_ALPHA = 0.8
+LIKE_ALPHA = 1.1
+DEGREE_ALPHA = 1.5
 
-# Generate random profile image URLs to use for users
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+WORDS = LoremProvider.word_list
+
+# Profile image URLs to use for users (strings only; nothing is downloaded)
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
-]
+] + ["/static/images/default-pic.png"]
 
-# Generate random header image URLs to use for users
+# Header images shipped with the app
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
+    "/static/images/nav-bg.png",
+]
+
+LOCATIONS = [
+    "Austin", "Berlin", "Bogota", "Cairo", "Hanoi", "Lagos", "Lima", "London",
+    "Melbourne", "Mumbai", "Nairobi", "Osaka", "Oslo", "Paris", "Seoul", "Toronto",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+TABLE_SALT = {'users': 1, 'messages': 2, 'follows': 3, 'likes': 4}
+
+
+def shard_rng(seed, table, shard):
+    return Random(seed * 1_000_003 + TABLE_SALT[table] * 10_007 + shard)
+
+
+@lru_cache(maxsize=None)
+def zipf(n, alpha):
+    return Zipf(n, alpha)
+
+
+def sentence(rng, min_words, max_words):
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return ' '.join(words).capitalize() + '.'
+
+
+def write_users(rng, writer, start, end, options):
+    for user_id in range(start, end):
+        username = f"{rng.choice(WORDS)}{rng.choice(WORDS)}{user_id}"
+        writer.writerow([
+            f"{username}@example.com",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            sentence(rng, 4, 10),
+            rng.choice(header_image_urls),
+            rng.choice(LOCATIONS),
+        ])
+
+
+def write_messages(rng, writer, start, end, options):
+    authors = zipf(options.users, POST_ALPHA)
+    now = options.end
+    for _ in range(start, end):
+        text = ' '.join(sentence(rng, 3, 12) for _ in range(rng.randint(1, 3)))
+        writer.writerow([
+            text[:MAX_WARBLER_LENGTH],
+            growing_datetime(rng, now, options.days).isoformat(sep=' '),
+            authors.sample(rng),
+        ])
+
+
+def pick_distinct(rng, ranks, count, exclude):
+    """Up to `count` distinct picks from the Zipf sampler `ranks`, skipping `exclude`."""
+
+    picked = set()
+    for _ in range(4):
+        missing = count - len(picked)
+        if missing <= 0:
+            break
+        picked.update(ranks.sample(rng) for _ in range(missing))
+        picked.discard(exclude)
+    return sorted(picked)[:count]
+
+
+def write_follows(rng, writer, start, end, options):
+    users = zipf(options.users, FOLLOW_ALPHA)
+    mean = options.follows / options.users
+    for follower in range(start, end):
+        degree = pareto_degree(rng, mean, DEGREE_ALPHA, options.users - 1)
+        for followed in pick_distinct(rng, users, degree, follower):
+            writer.writerow([followed, follower])
+
+
+def write_likes(rng, writer, start, end, options):
+    if not options.messages:
+        return
+    messages = zipf(options.messages, LIKE_ALPHA)
+    mean = options.likes / options.users
+    for liker in range(start, end):
+        degree = pareto_degree(rng, mean, DEGREE_ALPHA, options.messages)
+        for message in pick_distinct(rng, messages, degree, None):
+            writer.writerow([liker, message])
+
+
+# table -> (headers, row writer, number of ids to shard over)
+TABLES = {
+    'users': (USERS_CSV_HEADERS, write_users, lambda options: options.users),
+    'messages': (MESSAGES_CSV_HEADERS, write_messages, lambda options: options.messages),
+    'follows': (FOLLOWS_CSV_HEADERS, write_follows, lambda options: options.users),
+    'likes': (LIKES_CSV_HEADERS, write_likes, lambda options: options.users),
+}
+
+
+def part_path(options, table, shard):
+    return os.path.join(options.out, f"{table}.part-{shard:05d}.csv")
+
+
+def run_shard(task):
+    """Write one shard of one table to its own part file."""
+
+    table, shard, start, end, options = task
+    _, write_rows, _ = TABLES[table]
+    with open(part_path(options, table, shard), 'w', newline='') as part:
+        write_rows(shard_rng(options.seed, table, shard), csv.writer(part), start, end, options)
+    return table, shard
+
+
+def plan(options):
+    tasks = []
+    for table, (_, _, size) in TABLES.items():
+        if table == 'likes' and not options.likes:
+            continue
+        first, last = 1, size(options) + 1
+        for shard, start in enumerate(range(first, last, SHARD_SIZE)):
+            tasks.append((table, shard, start, min(start + SHARD_SIZE, last), options))
+    return tasks
+
+
+def concatenate(options, tasks):
+    """Join the part files of every table into `<table>.csv`, in shard order."""
+
+    shards = {}
+    for table, shard, *_ in tasks:
+        shards.setdefault(table, []).append(shard)
+    for table, table_shards in shards.items():
+        headers, _, _ = TABLES[table]
+        with open(os.path.join(options.out, f"{table}.csv"), 'w', newline='') as output:
+            csv.writer(output).writerow(headers)
+            for shard in sorted(table_shards):
+                path = part_path(options, table, shard)
+                with open(path, newline='') as part:
+                    shutil.copyfileobj(part, output)
+                os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs offline.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="approximate number of follow rows")
+    parser.add_argument('--likes', type=int, default=NUM_LIKES,
+                        help="approximate number of like rows (0 skips likes.csv)")
+    parser.add_argument('--days', type=int, default=730,
+                        help="spread message timestamps over this many days")
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        default=datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0),
+                        help="latest message timestamp (default: today 00:00 UTC)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default='generator')
+    options = parser.parse_args()
+
+    os.makedirs(options.out, exist_ok=True)
+    tasks = plan(options)
+    with Pool(options.workers) as pool:
+        for table, shard in pool.imap_unordered(run_shard, tasks):
+            print(f"{table} shard {shard} done")
+    concatenate(options, tasks)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,83 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from datetime import timedelta
+from itertools import accumulate
+from math import exp, expm1, log, log1p
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+class Zipf:
+    """Sampler of Zipf-distributed ranks 1..n in constant memory.
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    Rank 1 is the most popular; the k-th rank is picked with probability
+    proportional to 1 / k**alpha. Uses rejection-inversion (Hörmann and
+    Derflinger, 1996): a continuous hat function is sampled by inversion and
+    rounded, and the few draws falling outside the exact histogram are
+    rejected. No per-rank weights are kept, so 100M ranks cost as little
+    memory as 100.
+    """
 
-    return datetime.fromtimestamp(random_timestamp)
+    def __init__(self, n, alpha):
+        self.n = n
+        self.alpha = alpha
+        self._low = self._h_integral(1.5) - 1
+        self._high = self._h_integral(n + 0.5)
+        self._squeeze = 2 - self._h_integral_inverse(self._h_integral(2.5) - self._h(2))
+
+    def sample(self, rng):
+        while True:
+            u = self._high + rng.random() * (self._low - self._high)
+            x = self._h_integral_inverse(u)
+            k = min(max(int(x + 0.5), 1), self.n)
+            if k - x <= self._squeeze or u >= self._h_integral(k + 0.5) - self._h(k):
+                return k
+
+    def _h(self, x):
+        return exp(-self.alpha * log(x))
+
+    def _h_integral(self, x):
+        log_x = log(x)
+        return _expm1_ratio((1 - self.alpha) * log_x) * log_x
+
+    def _h_integral_inverse(self, x):
+        t = max(x * (1 - self.alpha), -1)
+        return exp(_log1p_ratio(t) * x)
+
+
+def _log1p_ratio(x):
+    # log(1 + x) / x, continuous at 0
+    if abs(x) > 1e-8:
+        return log1p(x) / x
+    return 1 - x * (0.5 - x * (1 / 3 - 0.25 * x))
+
+
+def _expm1_ratio(x):
+    # (exp(x) - 1) / x, continuous at 0
+    if abs(x) > 1e-8:
+        return expm1(x) / x
+    return 1 + x * 0.5 * (1 + x * (1 / 3) * (1 + 0.25 * x))
+
+
+def pareto_degree(rng, mean, alpha, cap):
+    """Heavy-tailed non-negative integer with roughly the given mean, at most `cap`."""
+
+    scale = mean * (alpha - 1) / alpha
+    return min(cap, int(scale * rng.paretovariate(alpha)))
+
+
+# share of posts per hour of day (UTC): quiet nights, busy evenings
+HOURLY_ACTIVITY = [1, 1, 1, 1, 1, 2, 3, 4, 5, 5, 5, 6, 6, 5, 5, 5, 6, 7, 8, 9, 9, 7, 4, 2]
+HOURLY_CUM_WEIGHTS = list(accumulate(HOURLY_ACTIVITY))
+
+
+def growing_datetime(rng, now, days):
+    """Datetime in the last `days` days from a platform whose traffic grows over time.
+
+    Post volume rises linearly towards `now` and follows a daily cycle.
+    """
+
+    age = days * (1 - rng.random() ** 0.5)
+    day = (now - timedelta(days=age)).replace(hour=0, minute=0, second=0, microsecond=0)
+    hour = rng.choices(range(24), cum_weights=HOURLY_CUM_WEIGHTS)[0]
+    moment = day + timedelta(hours=hour, seconds=rng.randrange(3600),
+                             microseconds=rng.randrange(1_000_000))
+    return min(moment, now)
@@ -0,0 +1,31 @@
+"""Gunicorn settings and hooks for multiprocess Prometheus metrics.
+
+Workers are threaded: a login holds its request thread while bcrypt runs,
+and CredentialVerifier keeps logins to fewer than GUNICORN_THREADS threads
+per process, so the rest keep serving pages during a login storm.
+
+Workers write metric samples to PROMETHEUS_MULTIPROC_DIR; the directory is
+emptied when the master starts and a dead worker's live gauges are dropped.
+
+    PROMETHEUS_MULTIPROC_DIR=/tmp/warbler-metrics gunicorn -c gunicorn.conf.py app:app
+"""
+
+import os
+import shutil
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def on_starting(server):
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
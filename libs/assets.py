@@ -0,0 +1,194 @@
+"""
+  Fingerprinted, precompressed static assets
+
+Build step (run before deploying; the Docker image does it):
+
+    python -m libs.assets            # static/ -> static/dist/
+
+copies every file under static/ to static/dist/ with a content hash in its
+name, minifies CSS (rewriting its /static/ references to the hashed names),
+writes .gz (and .br when the brotli package is installed) next to text
+assets and records everything in static/dist/manifest.json.
+
+At runtime `url_for('static', filename=...)` resolves through the manifest,
+and hashed files are served with immutable caching and the best precompressed
+variant the client accepts. Files missing from the manifest (e.g. in
+development, before a build) get a ?v=<content hash> query string instead.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+from functools import lru_cache
+
+from flask import current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.txt', '.json', '.map'}
+
+STATIC_URL = re.compile(r'''url\(\s*(['"]?)/static/([^'")]+)\1\s*\)''')
+
+
+def minify_css(css):
+    '''Drop comments and redundant whitespace.'''
+
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,])\s*', r'\1', css)
+    css = css.replace(': ', ':').replace(';}', '}')
+    return css.strip()
+
+
+def hashed_name(path, content):
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+
+def write_variants(path, content):
+    '''Write `content` to `path` plus .gz/.br copies for text formats.'''
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as output:
+        output.write(content)
+    if os.path.splitext(path)[1] not in COMPRESSIBLE:
+        return
+    with open(path + '.gz', 'wb') as output:
+        # mtime=0 keeps builds byte-for-byte reproducible
+        output.write(gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as output:
+            output.write(brotli.compress(content, quality=11))
+
+
+def build_assets(static_folder):
+    '''Fingerprint everything under `static_folder` into its dist/ directory.'''
+
+    dist = os.path.join(static_folder, DIST_DIR)
+    sources = []
+    for root, dirs, files in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(static_folder) and DIST_DIR in dirs:
+            dirs.remove(DIST_DIR)
+        for name in files:
+            sources.append(os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/'))
+
+    manifest = {}
+    # stylesheets last, so their url(/static/...) references can be rewritten
+    for filename in sorted(sources, key=lambda name: (name.endswith('.css'), name)):
+        with open(os.path.join(static_folder, filename), 'rb') as source:
+            content = source.read()
+        if filename.endswith('.css'):
+            css = STATIC_URL.sub(
+                lambda match: f"url({match[1]}/static/{DIST_DIR}/{manifest.get(match[2], match[2])}{match[1]})",
+                content.decode('utf-8'))
+            content = minify_css(css).encode('utf-8')
+        manifest[filename] = hashed_name(filename, content)
+        write_variants(os.path.join(dist, manifest[filename]), content)
+
+    with open(os.path.join(dist, MANIFEST), 'w') as output:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+    return manifest
+
+
+@lru_cache(maxsize=1024)
+def _file_version(path, mtime):
+    with open(path, 'rb') as static_file:
+        return hashlib.sha256(static_file.read()).hexdigest()[:12]
+
+
+def static_version(filename):
+    '''Short content hash of a file in the static folder, or None.'''
+
+    path = os.path.join(current_app.static_folder, filename)
+    try:
+        return _file_version(path, os.stat(path).st_mtime)
+    except OSError:
+        return None
+
+
+class Assets:
+    '''Resolves static URLs through the build manifest and serves the results.'''
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        path = os.path.join(app.static_folder, DIST_DIR, MANIFEST)
+        try:
+            with open(path) as manifest:
+                self.manifest = json.load(manifest)
+        except FileNotFoundError:
+            self.manifest = {}
+        self.static_url_path = app.static_url_path + '/'
+        app.url_defaults(self._resolve_static)
+        app.view_functions['static'] = self.serve
+        app.jinja_env.filters['asset'] = self.asset_url
+
+    def _resolve_static(self, endpoint, values):
+        if endpoint != 'static' or 'v' in values:
+            return
+        filename = values['filename']
+        if filename in self.manifest:
+            values['filename'] = f"{DIST_DIR}/{self.manifest[filename]}"
+        elif not filename.startswith(DIST_DIR + '/'):
+            version = static_version(filename)
+            if version:
+                values['v'] = version
+
+    def asset_url(self, url):
+        '''Jinja filter: fingerprinted URL for a "/static/..." path stored as data
+        (e.g. the default user images); other URLs are returned unchanged.'''
+
+        if url and url.startswith(self.static_url_path):
+            return url_for('static', filename=url[len(self.static_url_path):])
+        return url
+
+    def serve(self, filename):
+        static_folder = current_app.static_folder
+        if not filename.startswith(DIST_DIR + '/'):
+            response = current_app.send_static_file(filename)
+            # a stale or made-up version keeps the default revalidating headers,
+            # or the current bytes would be cached for a year under it
+            version = request.args.get('v')
+            if version and version == static_version(filename):
+                response.headers['Cache-Control'] = IMMUTABLE
+            return response
+
+        response = None
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if (request.accept_encodings[encoding]
+                    and os.path.isfile(os.path.join(static_folder, filename + suffix))):
+                response = send_from_directory(
+                    static_folder, filename + suffix,
+                    mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+                response.headers['Content-Encoding'] = encoding
+                break
+        if response is None:
+            response = send_from_directory(static_folder, filename)
+        if os.path.splitext(filename)[1] in COMPRESSIBLE:
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+
+assets = Assets()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fingerprint and precompress static assets.')
+    parser.add_argument('static_folder', nargs='?',
+                        default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static'))
+    args = parser.parse_args()
+    built = build_assets(args.static_folder)
+    print(f"{len(built)} assets written to {os.path.join(args.static_folder, DIST_DIR)}")
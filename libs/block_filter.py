@@ -0,0 +1,101 @@
+"""
+  Cached sets of the users each user has blocked or is blocked by
+"""
+import threading
+from collections import OrderedDict
+from typing import FrozenSet, NamedTuple
+
+from sqlalchemy import literal, select, union_all
+
+from models import db, Blocking
+
+
+class BlockSet(NamedTuple):
+    '''Ids a user has blocked and ids that have blocked them.'''
+
+    blocked: FrozenSet[int]
+    blocked_by: FrozenSet[int]
+
+    @property
+    def hidden(self):
+        '''Users whose content the owner of this set must not see.'''
+
+        return self.blocked | self.blocked_by
+
+
+EMPTY = BlockSet(frozenset(), frozenset())
+
+
+class BlockFilter:
+    '''LRU of BlockSets keyed by user id and checked against `relations_version`.
+
+    Blocking and unblocking bump `relations_version` of both users (see
+    `User.block`), so a cached set is used only while the version it was
+    loaded at is current, and a block made in one worker invalidates the
+    cached sets of every other worker on their next request.
+    '''
+
+    def __init__(self, app=None):
+        self.max_entries = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_entries = app.config.setdefault('BLOCK_CACHE_SIZE', 10000)
+
+    def for_user(self, user):
+        '''The BlockSet of `user` (a User row), loaded with one query on a miss.'''
+
+        if user is None:
+            return EMPTY
+        blocks = self.cached(user.id, user.relations_version)
+        if blocks is None:
+            blocks = self.store(user.id, user.relations_version, self.load(user.id))
+        return blocks
+
+    def cached(self, user_id, version):
+        '''The cached BlockSet of `user_id` if it was loaded at `version`, else None.'''
+
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached is not None and cached[0] == version:
+                self._entries.move_to_end(user_id)
+                return cached[1]
+        return None
+
+    def store(self, user_id, version, blocks):
+        if self.max_entries:
+            with self._lock:
+                self._entries[user_id] = (version, blocks)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return blocks
+
+    @staticmethod
+    def statement(user_id):
+        '''(other user id, blocked by `user_id`?) rows of every block involving `user_id`.'''
+
+        return union_all(
+            select(Blocking.blockee_id, literal(True)).where(Blocking.blocker_id == user_id),
+            select(Blocking.blocker_id, literal(False)).where(Blocking.blockee_id == user_id))
+
+    @staticmethod
+    def from_rows(rows):
+        blocked, blocked_by = set(), set()
+        for other_id, by_user in rows:
+            (blocked if by_user else blocked_by).add(other_id)
+        return BlockSet(frozenset(blocked), frozenset(blocked_by))
+
+    @classmethod
+    def load(cls, user_id):
+        return cls.from_rows(db.session.execute(cls.statement(user_id)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+block_filter = BlockFilter()
@@ -0,0 +1,82 @@
+"""
+  Bounded bcrypt password verification
+"""
+import threading
+import time
+
+import bcrypt
+
+from libs.metrics import PASSWORD_CHECK
+
+
+class VerifierSaturated(Exception):
+    '''Too many password checks are already running or queued.'''
+
+
+def hash_cost(pw_hash: str):
+    '''Work factor of a bcrypt hash ("$2b$12$..." -> 12), or None if unparsable.'''
+
+    try:
+        return int(pw_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def _checkpw(password: bytes, pw_hash: bytes) -> bool:
+    started = time.perf_counter()
+    try:
+        return bcrypt.checkpw(password, pw_hash)
+    finally:
+        PASSWORD_CHECK.observe(time.perf_counter() - started)
+
+
+class CredentialVerifier:
+    '''Bounds how many request threads may be busy checking passwords.
+
+    Workers are threaded (gunicorn gthread, see gunicorn.conf.py), and a
+    bcrypt check holds its request thread for its whole run. At most
+    CREDENTIAL_WORKERS checks run at once and CREDENTIAL_QUEUE_SIZE more may
+    wait for a turn, and together they are kept below REQUEST_THREADS, so a
+    login storm always leaves threads free for timeline traffic. Beyond that
+    `check` raises VerifierSaturated straight away instead of queueing.
+    bcrypt releases the GIL, so running checks don't stall the other threads.
+    '''
+
+    def __init__(self, app=None):
+        self._slots = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        workers = app.config.setdefault('CREDENTIAL_WORKERS', 2)
+        queue_size = app.config.setdefault('CREDENTIAL_QUEUE_SIZE', 4)
+        threads = app.config.setdefault('REQUEST_THREADS', 8)
+        self.timeout = app.config.setdefault('CREDENTIAL_TIMEOUT', 10)
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        self.limit = max(1, min(workers + queue_size, threads - 1))
+        self._running = threading.Semaphore(max(1, min(workers, self.limit)))
+        self._slots = threading.BoundedSemaphore(self.limit)
+
+    def check(self, pw_hash: str, password: str) -> bool:
+        if self._slots is None:
+            raise RuntimeError('CredentialVerifier.init_app() has not been called')
+        if not self._slots.acquire(blocking=False):
+            raise VerifierSaturated()
+        try:
+            if not self._running.acquire(timeout=self.timeout):
+                raise VerifierSaturated()
+            try:
+                return _checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+            finally:
+                self._running.release()
+        finally:
+            self._slots.release()
+
+    def needs_rehash(self, pw_hash: str) -> bool:
+        '''Was `pw_hash` made with a different work factor than BCRYPT_LOG_ROUNDS?'''
+
+        cost = hash_cost(pw_hash)
+        return cost is not None and cost != self.rounds
+
+
+credentials = CredentialVerifier()
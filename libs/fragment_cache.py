@@ -0,0 +1,98 @@
+"""
+  Memory-bounded LRU cache of rendered message fragments
+"""
+import threading
+from collections import OrderedDict
+
+from flask import current_app, g
+from markupsafe import Markup
+
+MESSAGE_FRAGMENT = 'common/message.fragment.html'
+
+
+class FragmentCache:
+    '''LRU of rendered HTML, bounded by the total encoded size of its entries.
+
+    Keys start with the message id so every variant of a message can be
+    dropped at once with `evict`.
+    '''
+
+    def __init__(self, app=None):
+        self.max_bytes = 0
+        self._entries = OrderedDict()
+        self._by_message = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_bytes = app.config.setdefault('FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024)
+        app.jinja_env.globals['render_message'] = self.render_message
+
+    def get(self, key):
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return fragment
+
+    def put(self, key, fragment):
+        size = len(fragment.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = fragment
+            self._by_message.setdefault(key[0], set()).add(key)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def evict(self, message_id):
+        '''Drop every cached variant of a message.'''
+
+        with self._lock:
+            for key in list(self._by_message.get(message_id, ())):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_message.clear()
+            self._size = 0
+
+    def _discard(self, key):
+        fragment = self._entries.pop(key)
+        self._size -= len(fragment.encode())
+        variants = self._by_message[key[0]]
+        variants.discard(key)
+        if not variants:
+            del self._by_message[key[0]]
+
+    def render_message(self, message):
+        '''Jinja global: the message fragment for the current viewer.
+
+        Apart from the message itself the fragment depends on its like count,
+        its author's public profile (covered by `profile_version`) and on
+        whether the viewer owns or likes the message, so those make up the key.
+        '''
+
+        own, liked = g.viewer.owns(message), g.viewer.likes(message)
+        key = (message.id, message.user_id, message.user.profile_version, message.likes_count,
+               own, liked)
+        fragment = self.get(key) if self.max_bytes else None
+        if fragment is None:
+            template = current_app.jinja_env.get_template(MESSAGE_FRAGMENT)
+            fragment = template.render(message=message, own=own, liked=liked)
+            if self.max_bytes:
+                self.put(key, fragment)
+        return Markup(fragment)
+
+
+fragment_cache = FragmentCache()
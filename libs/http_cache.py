@@ -0,0 +1,75 @@
+"""
+  Conditional GETs for pages
+"""
+import hashlib
+import time
+
+from flask import current_app, g, make_response, request, session
+
+# logged in pages differ per viewer and must be revalidated on every view
+PAGE_CACHE_CONTROL = 'private, no-cache'
+
+
+def user_state(user):
+    '''What a page shows about `user` beyond its item list.'''
+
+    if user is None:
+        return None
+    return (user.id, user.profile_version, user.relations_version,
+            user.messages_count, user.following_count, user.followers_count,
+            user.likes_count)
+
+
+def message_state(messages):
+    '''Ids, like counts, authors' profile versions and the viewer's likes of a page of messages.'''
+
+    return [(message.id, message.likes_count, message.user.profile_version, g.viewer.likes(message))
+            for message in messages]
+
+
+def csrf_epoch():
+    '''Changes twice per CSRF token lifetime, so a revalidated page never
+    keeps a form token older than half of WTF_CSRF_TIME_LIMIT.'''
+
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+    return int(time.time() // (limit / 2))
+
+
+def not_modified(*parts):
+    '''Compute the page's weak ETag from `parts`; 304 if the client has it.
+
+    Call it once the data a page shows is loaded but before rendering:
+
+        response = not_modified(user_state(user), message_state(messages))
+        if response:
+            return response
+
+    The logged in user's own state and the CSRF epoch are always included.
+    Pages with pending flash messages are never short-circuited, since
+    rendering is what consumes them.
+    '''
+
+    if request.method != 'GET' or session.get('_flashes'):
+        return None
+    key = repr((user_state(g.user), csrf_epoch()) + parts)
+    g.etag = hashlib.sha1(key.encode()).hexdigest()
+    if request.if_none_match.contains_weak(g.etag):
+        response = make_response('', 304)
+        response.set_etag(g.etag, weak=True)
+        return response
+    return None
+
+
+def init_http_cache(app):
+    '''Set the caching headers of every page (static files: see libs.assets).'''
+
+    @app.after_request
+    def add_cache_headers(response):
+        if request.endpoint == 'static' or 'Cache-Control' in response.headers:
+            pass
+        elif g.get('etag'):
+            response.set_etag(g.etag, weak=True)
+            response.headers['Cache-Control'] = PAGE_CACHE_CONTROL
+        else:
+            response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        return response
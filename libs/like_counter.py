@@ -0,0 +1,105 @@
+"""
+  Write-behind buffer for per-message like counts
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import bindparam, update
+
+from models import db, Message
+
+logger = logging.getLogger(__name__)
+
+
+class LikeCounter:
+    '''Collects like count deltas in memory and applies them in batches.
+
+    Liking a popular message would otherwise make every liker update the same
+    `messages` row inside their transaction and queue on its lock. Instead
+    each worker sums the deltas per message and writes them with a single
+    executemany once the oldest pending delta is LIKE_FLUSH_SECONDS old or
+    LIKE_FLUSH_SIZE messages are pending, after the response has been sent.
+    Deltas still pending when the worker exits are flushed then; anything
+    lost to a crash is restored by `Message.reconcile_likes`.
+    '''
+
+    def __init__(self, app=None):
+        self.max_age = 0
+        self.max_pending = 0
+        self._pending = Counter()
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_age = app.config.setdefault('LIKE_FLUSH_SECONDS', 2.0)
+        self.max_pending = app.config.setdefault('LIKE_FLUSH_SIZE', 500)
+        self._app = app
+        app.teardown_request(self._flush_if_due)
+        atexit.register(self._flush_at_exit)
+
+    def add(self, message_id, delta):
+        '''Record a change of `delta` likes; call after the like is committed.'''
+
+        with self._lock:
+            self._pending[message_id] += delta
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+
+    def pending(self, message_id):
+        with self._lock:
+            return self._pending.get(message_id, 0)
+
+    def due(self):
+        return self._oldest is not None and (
+            len(self._pending) >= self.max_pending
+            or time.monotonic() - self._oldest >= self.max_age)
+
+    def flush(self):
+        '''Apply every pending delta; returns the number of messages updated.'''
+
+        with self._lock:
+            pending = {id: delta for id, delta in self._pending.items() if delta}
+            self._pending.clear()
+            self._oldest = None
+        if not pending:
+            return 0
+
+        statement = (update(Message.__table__)
+                     .where(Message.__table__.c.id == bindparam('message_id'))
+                     .values(likes_count=Message.__table__.c.likes_count + bindparam('delta')))
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(statement, [{'message_id': id, 'delta': delta}
+                                               for id, delta in sorted(pending.items())])
+        except Exception:
+            # keep the deltas for the next attempt
+            with self._lock:
+                self._pending.update(pending)
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+            raise
+        return len(pending)
+
+    def _flush_if_due(self, exc):
+        if self.due():
+            self._safe_flush()
+
+    def _flush_at_exit(self):
+        if self._pending and self._app is not None:
+            with self._app.app_context():
+                self._safe_flush()
+
+    def _safe_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("could not flush like counts")
+
+
+like_counter = LikeCounter()
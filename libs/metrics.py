@@ -0,0 +1,117 @@
+"""
+  Prometheus metrics, aggregated across gunicorn workers
+"""
+import hmac
+import os
+import time
+
+from flask import (Response, abort, current_app, g, request, before_render_template,
+                   template_rendered)
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter,
+                               Gauge, Histogram, generate_latest, multiprocess)
+from sqlalchemy.pool import QueuePool
+
+# With PROMETHEUS_MULTIPROC_DIR set (see gunicorn.conf.py) every worker
+# writes its samples to mmapped files in that directory and /metrics sums
+# them, so a scrape sees the whole server whichever worker answers it.
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0)
+
+REQUEST_LATENCY = Histogram(
+    'warbler_request_duration_seconds', 'Time spent handling a request, by Flask endpoint.',
+    ['endpoint'])
+REQUESTS = Counter(
+    'warbler_requests_total', 'Requests handled, by Flask endpoint, method and status.',
+    ['endpoint', 'method', 'status'])
+IN_FLIGHT = Gauge(
+    'warbler_requests_in_flight', 'Requests currently being handled.',
+    multiprocess_mode='livesum')
+POOL_CHECKOUT = Histogram(
+    'warbler_db_pool_checkout_seconds', 'Time spent waiting for a database connection.',
+    buckets=FAST_BUCKETS)
+TEMPLATE_RENDER = Histogram(
+    'warbler_template_render_seconds', 'Time spent rendering a page template.',
+    ['template'], buckets=FAST_BUCKETS)
+PASSWORD_CHECK = Histogram(
+    'warbler_password_check_seconds', 'Time spent in bcrypt password verification.',
+    buckets=(.01, .025, .05, .1, .25, .5, 1.0, 2.5))
+
+
+class TimedQueuePool(QueuePool):
+    '''QueuePool that records how long each checkout waited for a connection.'''
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT.observe(time.perf_counter() - started)
+
+
+def metrics():
+    '''Text exposition of every metric, summed over workers in multiprocess mode.
+
+    Only served to scrapers presenting `Authorization: Bearer <METRICS_TOKEN>`;
+    everyone else, and everyone when no token is configured, gets a 404.
+    '''
+
+    token = current_app.config['METRICS_TOKEN']
+    given = request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(given.encode(), f'Bearer {token}'.encode()):
+        abort(404)
+
+    registry = REGISTRY
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app):
+    '''Time every request and template render and serve them at /metrics
+    (to holders of METRICS_TOKEN).
+
+    Must be called before connect_db so server databases get TimedQueuePool
+    (SQLite keeps SQLAlchemy's default pool).
+    '''
+
+    app.config.setdefault('METRICS_TOKEN', None)
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        options.setdefault('poolclass', TimedQueuePool)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        IN_FLIGHT.inc()
+
+    @app.after_request
+    def remember_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def observe_request(error=None):
+        started = g.pop('request_started', None)
+        if started is None:
+            return
+        IN_FLIGHT.dec()
+        # unmatched URLs share one label so scanners can't grow the series count
+        endpoint = request.endpoint or 'unmatched'
+        REQUEST_LATENCY.labels(endpoint).observe(time.perf_counter() - started)
+        status = g.get('response_status', 500)
+        REQUESTS.labels(endpoint, request.method, str(status)).inc()
+
+    def start_template_timer(sender, template, context, **extra):
+        g.setdefault('template_started', []).append(time.perf_counter())
+
+    def observe_template(sender, template, context, **extra):
+        started = g.get('template_started')
+        if started:
+            TEMPLATE_RENDER.labels(template.name).observe(time.perf_counter() - started.pop())
+
+    before_render_template.connect(start_template_timer, app, weak=False)
+    template_rendered.connect(observe_template, app, weak=False)
+
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,86 @@
+"""
+  Keyset (cursor) pagination over (timestamp, id)
+"""
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from flask import current_app, request
+from sqlalchemy import and_, or_, true
+
+
+# largest BIGINT; ids beyond it make the database drivers raise OverflowError
+MAX_ID = 2 ** 63 - 1
+
+
+def parse_id(value: str) -> Optional[int]:
+    '''`value` as a row id, or None unless it is an integer from 0 to MAX_ID.'''
+
+    try:
+        id = int(value)
+    except ValueError:
+        return None
+    return id if 0 <= id <= MAX_ID else None
+
+
+class Cursor(NamedTuple):
+    '''Position of the last row of a page; the next page starts after it.'''
+
+    timestamp: datetime
+    id: int
+
+    def encode(self):
+        return f"{self.timestamp.isoformat()}_{self.id}"
+
+    @classmethod
+    def decode(cls, value: Optional[str]):
+        '''Parse a "before" cursor, returning None when missing or malformed.'''
+
+        if not value:
+            return None
+        timestamp, _, id = value.rpartition('_')
+        id = parse_id(id)
+        if id is None:
+            return None
+        try:
+            return cls(datetime.fromisoformat(timestamp), id)
+        except ValueError:
+            return None
+
+
+class Page(NamedTuple):
+    items: list
+    next_cursor: Optional[str]
+
+
+def before(timestamp_column, id_column, cursor: Optional[Cursor]):
+    '''Filter rows strictly older than `cursor` in (timestamp, id) order.
+
+    Written as OR/AND rather than a row-value comparison so every backend
+    can turn it into a range scan of a (..., timestamp, id) index.
+    '''
+
+    if cursor is None:
+        return true()
+    return or_(
+        timestamp_column < cursor.timestamp,
+        and_(timestamp_column == cursor.timestamp, id_column < cursor.id),
+    )
+
+
+def page_args():
+    '''Read the "before" cursor and page size from the query string.'''
+
+    cursor = Cursor.decode(request.args.get('before'))
+    default = current_app.config.get('PAGE_SIZE', 100)
+    maximum = current_app.config.get('MAX_PAGE_SIZE', 100)
+    limit = request.args.get('limit', default, type=int)
+    return cursor, max(1, min(limit, maximum))
+
+
+def paginate(rows, limit, key=lambda row: Cursor(row.timestamp, row.id)):
+    '''Turn `limit + 1` fetched rows into a page and the cursor of the next one.'''
+
+    items = list(rows[:limit])
+    if len(rows) <= limit:
+        return Page(items, None)
+    return Page(items, key(items[-1]).encode())
@@ -0,0 +1,183 @@
+"""
+  Opt-in sampling profiler for production requests
+"""
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import request
+
+TRIGGER_FILE = 'capture.trigger'
+
+
+def collapse(frame):
+    '''One stack in collapsed format: outermost frame first, separated by ";".'''
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    '''Samples the stacks of selected requests from a background thread.
+
+    Nothing runs unless PROFILE_DIR is set. A request is profiled when its
+    endpoint is listed in PROFILE_ENDPOINTS, when it falls in the 1-in-N
+    PROFILE_SAMPLE_RATE sample, or while a timed capture is running. Every
+    PROFILE_INTERVAL seconds the sampler reads the current frame of each
+    profiled thread; stacks are counted per endpoint and written as
+    collapsed stacks (flamegraph.pl / speedscope input) to PROFILE_DIR,
+    keeping the newest PROFILE_KEEP files.
+
+    A capture is started by writing a deadline to PROFILE_DIR/capture.trigger,
+    which every worker sharing the directory checks about once a second.
+
+    While no request is being profiled the sampler thread blocks on an
+    Event, waking only to write out stacks it has already gathered.
+    '''
+
+    def __init__(self, app=None):
+        self.directory = None
+        self._active = {}
+        # set while `_active` is not empty
+        self._busy = threading.Event()
+        self._stacks = Counter()
+        self._lock = threading.Lock()
+        self._thread_pid = None
+        self._capture_until = 0
+        self._capture_checked = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config.setdefault('PROFILE_DIR', None)
+        self.endpoints = set(app.config.setdefault('PROFILE_ENDPOINTS', ()))
+        self.sample_rate = app.config.setdefault('PROFILE_SAMPLE_RATE', 0)
+        self.interval = app.config.setdefault('PROFILE_INTERVAL', 0.005)
+        self.flush_seconds = app.config.setdefault('PROFILE_FLUSH_SECONDS', 60)
+        self.keep = app.config.setdefault('PROFILE_KEEP', 50)
+        app.before_request(self._start_request)
+        app.teardown_request(self._stop_request)
+
+    # -- request hooks --------------------------------------------------------
+
+    def _start_request(self):
+        if not self.directory or not self._wanted(request.endpoint):
+            return
+        self._ensure_sampler()
+        with self._lock:
+            self._active[threading.get_ident()] = request.endpoint or 'unmatched'
+            self._busy.set()
+
+    def _stop_request(self, error=None):
+        if self._active:
+            with self._lock:
+                self._active.pop(threading.get_ident(), None)
+                if not self._active:
+                    self._busy.clear()
+
+    def _wanted(self, endpoint):
+        if endpoint in self.endpoints or self.capturing():
+            return True
+        return bool(self.sample_rate) and random.randrange(self.sample_rate) == 0
+
+    # -- timed captures -------------------------------------------------------
+
+    def trigger(self, seconds):
+        '''Profile every request in every worker for the next `seconds` seconds.'''
+
+        os.makedirs(self.directory, exist_ok=True)
+        until = time.time() + seconds
+        path = os.path.join(self.directory, TRIGGER_FILE)
+        with open(path + '.tmp', 'w') as trigger:
+            trigger.write(str(until))
+        os.replace(path + '.tmp', path)
+        self._capture_checked = 0
+        return until
+
+    def capturing(self):
+        if not self.directory:
+            return False
+        now = time.time()
+        if now - self._capture_checked >= 1:
+            self._capture_checked = now
+            try:
+                with open(os.path.join(self.directory, TRIGGER_FILE)) as trigger:
+                    self._capture_until = float(trigger.read())
+            except (OSError, ValueError):
+                self._capture_until = 0
+        return now < self._capture_until
+
+    # -- sampling -------------------------------------------------------------
+
+    def _ensure_sampler(self):
+        # started lazily so each forked gunicorn worker gets its own thread
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._run, name='sampling-profiler', daemon=True).start()
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_seconds
+        was_capturing = False
+        while True:
+            if self._busy.is_set():
+                time.sleep(self.interval)
+            else:
+                # idle: wait for a profiled request, or until the stacks
+                # gathered so far are due to be written
+                self._busy.wait(max(0, next_flush - time.monotonic()) if self._stacks else None)
+            self.sample()
+            capturing = self.capturing()
+            if time.monotonic() >= next_flush or (was_capturing and not capturing):
+                self.flush()
+                next_flush = time.monotonic() + self.flush_seconds
+            was_capturing = capturing
+
+    def sample(self):
+        '''Record the current stack of every profiled request thread.'''
+
+        if not self._active:
+            return
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, endpoint in list(self._active.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    self._stacks[f"{endpoint};{collapse(frame)}"] += 1
+
+    def flush(self):
+        '''Write the stacks gathered so far to a new file, dropping the oldest files.'''
+
+        with self._lock:
+            stacks, self._stacks = self._stacks, Counter()
+        if not stacks:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        path = os.path.join(self.directory, f"profile-{stamp}-{os.getpid()}.collapsed")
+        with open(path, 'w') as output:
+            for stack, count in stacks.most_common():
+                output.write(f"{stack} {count}\n")
+        self._rotate()
+        return path
+
+    def _rotate(self):
+        profiles = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.name.endswith('.collapsed')),
+            key=lambda entry: entry.stat().st_mtime)
+        for entry in profiles[:-self.keep]:
+            os.remove(entry.path)
+
+
+profiler = SamplingProfiler()
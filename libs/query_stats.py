@@ -0,0 +1,128 @@
+"""
+  Per-request SQL statement counting and query budgets
+"""
+import logging
+import threading
+import time
+from contextlib import ContextDecorator
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# collectors currently recording on this thread (a request, a test budget...)
+_local = threading.local()
+
+
+class QueryStats:
+    '''Statements, DB time and rows seen while this collector was active.
+
+    Rows are counted where the DBAPI reports them (cursor.rowcount):
+    psycopg2 does for SELECTs, sqlite3 only for INSERT/UPDATE/DELETE.
+    '''
+
+    def __init__(self, keep_statements=False):
+        self.statements = 0
+        self.duration = 0.0
+        self.rows = 0
+        self.keep_statements = keep_statements
+        self.executed = []
+
+    def record(self, statement, elapsed, rows):
+        self.statements += 1
+        self.duration += elapsed
+        self.rows += max(rows, 0)
+        if self.keep_statements:
+            self.executed.append(statement)
+
+    def start(self):
+        _collectors().append(self)
+        return self
+
+    def stop(self):
+        collectors = _collectors()
+        if self in collectors:
+            collectors.remove(self)
+        return self
+
+
+def _collectors():
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+    return _local.collectors
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    for collector in _collectors():
+        collector.record(statement, elapsed, cursor.rowcount)
+
+
+class query_budget(ContextDecorator):
+    '''Fail if the wrapped block (or decorated test) runs more than `limit` statements.
+
+        with query_budget(6):
+            client.get('/')
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def __enter__(self):
+        self.stats = QueryStats(keep_statements=True).start()
+        return self.stats
+
+    def __exit__(self, *exc_info):
+        self.stats.stop()
+        if exc_info[0] is None and self.stats.statements > self.limit:
+            executed = '\n'.join(self.stats.executed)
+            raise AssertionError(
+                f"{self.stats.statements} SQL statements executed, budget is {self.limit}:\n{executed}")
+        return False
+
+
+def init_query_stats(app):
+    '''Count the statements of every request and report them on the response.
+
+    Adds X-DB-Queries / X-DB-Time-ms / X-DB-Rows and a Server-Timing entry,
+    and logs requests that exceed QUERY_WARN_THRESHOLD statements.
+    '''
+
+    app.config.setdefault('QUERY_STATS_HEADERS', True)
+    app.config.setdefault('QUERY_WARN_THRESHOLD', 50)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats().start()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.get('query_stats')
+        if stats is None:
+            return response
+        stats.stop()
+        duration_ms = stats.duration * 1000
+        if app.config['QUERY_STATS_HEADERS']:
+            response.headers['X-DB-Queries'] = str(stats.statements)
+            response.headers['X-DB-Time-ms'] = f"{duration_ms:.2f}"
+            response.headers['X-DB-Rows'] = str(stats.rows)
+            response.headers.add(
+                'Server-Timing', f'db;dur={duration_ms:.2f};desc="{stats.statements} queries"')
+        level = logging.WARNING if stats.statements > app.config['QUERY_WARN_THRESHOLD'] else logging.DEBUG
+        logger.log(level, "%s %s: %d queries, %.2fms db, %d rows",
+                   request.method, request.path, stats.statements, duration_ms, stats.rows)
+        return response
+
+    @app.teardown_request
+    def stop_query_stats(error=None):
+        stats = g.get('query_stats')
+        if stats is not None:
+            stats.stop()
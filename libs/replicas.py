@@ -0,0 +1,86 @@
+"""
+  Read replicas and connection pool settings
+
+Replica URIs (SQLALCHEMY_REPLICA_URIS) become Flask-SQLAlchemy binds named
+replica_0, replica_1, ... Views decorated with @read_replica() run their
+queries on one of them, picked per request; everything else, and every write
+(flushes and INSERT/UPDATE/DELETE statements) uses the primary.
+
+Replicas lag behind the primary, so a request that writes marks the client's
+session: for REPLICA_STICKY_SECONDS afterwards its reads stay on the primary
+and the page after a POST redirect shows what was just written.
+"""
+import random
+import time
+from typing import Callable
+
+import flask_sqlalchemy.session
+from flask import current_app, g, has_app_context, session
+from sqlalchemy.sql.dml import UpdateBase
+
+# session key holding the time until which the client reads from the primary
+PRIMARY_UNTIL_KEY = 'primary_until'
+
+
+class RoutingSession(flask_sqlalchemy.session.Session):
+    '''Session sending reads of replica-routed requests to `g.read_replica`.'''
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            if self._flushing or isinstance(clause, UpdateBase):
+                g.wrote_primary = True
+            elif g.get('read_replica'):
+                return self._db.engines[g.read_replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def replica_binds(app):
+    return app.extensions.get('replicas', [])
+
+
+def reads_from_primary(session_data):
+    '''True while a client is inside its read-your-writes window.'''
+
+    return session_data.get(PRIMARY_UNTIL_KEY, 0) > time.time()
+
+
+def read_replica():
+    '''Run the view's queries on a read replica, unless the client wrote recently.'''
+    def wrapper(func: Callable):
+        def handler(*args, **kwargs):
+            replicas = replica_binds(current_app)
+            if replicas and not reads_from_primary(session):
+                g.read_replica = random.choice(replicas)
+            return func(*args, **kwargs)
+        handler.__name__ = func.__name__
+        return handler
+    return wrapper
+
+
+def init_engines(app):
+    '''Apply the pool settings and register the replica binds.
+
+    Must be called before connect_db. Pool settings only apply to server
+    databases; SQLite keeps SQLAlchemy's default pool.
+    '''
+
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        options.setdefault('pool_size', app.config['DB_POOL_SIZE'])
+        options.setdefault('max_overflow', app.config['DB_MAX_OVERFLOW'])
+        options.setdefault('pool_timeout', app.config['DB_POOL_TIMEOUT'])
+        options.setdefault('pool_recycle', app.config['DB_POOL_RECYCLE'])
+        options.setdefault('pool_pre_ping', app.config['DB_POOL_PRE_PING'])
+
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    replicas = []
+    for index, uri in enumerate(app.config['SQLALCHEMY_REPLICA_URIS']):
+        binds[f'replica_{index}'] = uri
+        replicas.append(f'replica_{index}')
+    app.extensions['replicas'] = replicas
+
+    @app.after_request
+    def stick_to_primary(response):
+        if replicas and g.get('wrote_primary'):
+            session[PRIMARY_UNTIL_KEY] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+        return response
@@ -0,0 +1,110 @@
+"""
+  Full-text search over messages
+
+  SQLite (tests, local dev) keeps an external-content FTS5 table in sync with
+  `messages` through triggers; PostgreSQL/CockroachDB use a GIN index over
+  to_tsvector(text), which the database maintains itself. Both are created
+  together with the `messages` table.
+"""
+import re
+
+from sqlalchemy import DDL, event, func, literal_column, or_, select, table, column, text, true
+
+from models import db, Follows, Message, User
+
+TS_CONFIG = 'english'
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+    "USING fts5(text, content='messages', content_rowid='id')",
+    # triggers keep the external-content table in step with every write,
+    # including bulk loads and deletes cascading from users
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); END",
+]
+
+for statement in SQLITE_DDL:
+    event.listen(Message.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+event.listen(
+    Message.__table__, 'before_drop',
+    DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect='sqlite'))
+event.listen(
+    Message.__table__, 'after_create',
+    DDL(f"CREATE INDEX IF NOT EXISTS ix_messages_text_fts ON messages "
+        f"USING gin (to_tsvector('{TS_CONFIG}', text))")
+    .execute_if(dialect=('postgresql', 'cockroachdb')))
+
+messages_fts = table('messages_fts', column('rowid'), column('text'))
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def _is_sqlite():
+    return _dialect() == 'sqlite'
+
+
+def _fts5_query(query: str):
+    '''Quote every word so user input can't use (or break) FTS5 query syntax.'''
+
+    words = re.findall(r'\w+', query)
+    return ' '.join(f'"{word}"' for word in words)
+
+
+def rebuild_index():
+    '''Rebuild the whole index from `messages` (after bulk loads).
+
+    CockroachDB has no REINDEX; it keeps the GIN index up to date during
+    the load and compacts it in the background, so there is nothing to do.
+    '''
+
+    dialect = _dialect()
+    if dialect == 'sqlite':
+        db.session.execute(text("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+    elif dialect == 'postgresql':
+        db.session.execute(text("REINDEX INDEX ix_messages_text_fts"))
+
+
+def search_messages(query: str, viewer_id=None, limit=20, offset=0, hidden=frozenset()):
+    '''Messages matching `query`, best match first.
+
+    Messages of private users are only returned to themselves and their
+    followers; messages of users in `hidden` (see libs/block_filter.py) are
+    left out.
+    '''
+
+    if _is_sqlite():
+        terms = _fts5_query(query)
+        if not terms:
+            return []
+        rank = func.bm25(literal_column('messages_fts'))
+        stmt = (select(Message)
+                .join(messages_fts, messages_fts.c.rowid == Message.id)
+                .where(literal_column('messages_fts').op('MATCH')(terms))
+                .order_by(rank, Message.id.desc()))
+    else:
+        document = func.to_tsvector(TS_CONFIG, Message.text)
+        tsquery = func.plainto_tsquery(TS_CONFIG, query)
+        stmt = (select(Message)
+                .where(document.op('@@')(tsquery))
+                .order_by(func.ts_rank(document, tsquery).desc(), Message.id.desc()))
+
+    followed = select(Follows.user_being_followed_id).where(
+        Follows.user_following_id == viewer_id)
+    stmt = (stmt
+            .join(User, User.id == Message.user_id)
+            .where(or_(User.is_private.is_(False),
+                       Message.user_id == viewer_id,
+                       Message.user_id.in_(followed)),
+                   Message.user_id.notin_(hidden) if hidden else true())
+            .options(Message.with_author())
+            .limit(limit)
+            .offset(offset))
+    return db.session.scalars(stmt).all()
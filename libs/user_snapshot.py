@@ -0,0 +1,127 @@
+"""
+  Snapshot of the logged in user kept in the session cookie
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from flask import session
+
+SNAPSHOT_KEY = "curr_user_snapshot"
+
+
+class UserSnapshot(NamedTuple):
+    '''The few user fields every page layout needs (nav bar, ownership checks).'''
+
+    id: int
+    username: str
+    image_url: Optional[str]
+    header_image_url: Optional[str]
+    is_private: bool
+    profile_version: int
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.image_url,
+                   user.header_image_url, user.is_private, user.profile_version)
+
+
+class ProfileVersions:
+    '''LRU of users' `profile_version`, re-read at most once per SNAPSHOT_CHECK_SECONDS.
+
+    Checking the snapshot against the database on every request would cost a
+    query per page; with this cache a profile change or account deletion made
+    through another worker reaches this worker's pages within
+    SNAPSHOT_CHECK_SECONDS. Changes made through this worker are recorded by
+    `remember_user` right away.
+    '''
+
+    def __init__(self, app=None):
+        self.ttl = 0
+        self.max_entries = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.setdefault('SNAPSHOT_CHECK_SECONDS', 30)
+        self.max_entries = app.config.setdefault('SNAPSHOT_CHECK_CACHE_SIZE', 10000)
+
+    def get(self, user_id, load):
+        '''`user_id`'s profile_version, from `load(user_id)` if not checked lately.
+
+        `load` returns None for a deleted user; that is not cached, so the
+        session is logged out and the next request with it is anonymous.
+        '''
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._entries.move_to_end(user_id)
+                return entry[0]
+        version = load(user_id)
+        if version is None:
+            self.forget(user_id)
+        else:
+            self.store(user_id, version, now)
+        return version
+
+    def store(self, user_id, version, checked_at=None):
+        if checked_at is None:
+            checked_at = time.monotonic()
+        with self._lock:
+            self._entries[user_id] = (version, checked_at)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+profile_versions = ProfileVersions()
+
+
+def remember_user(user):
+    '''Store (or refresh) the snapshot of `user`; call after writing their profile.
+
+    The snapshot lives in the signed session cookie, so a refresh is seen by
+    every worker on the user's next request. Other sessions of the same user
+    notice the change through `profile_version` (see `load_snapshot`).
+    '''
+
+    snapshot = UserSnapshot.from_user(user)
+    session[SNAPSHOT_KEY] = list(snapshot)
+    profile_versions.store(snapshot.id, snapshot.profile_version)
+
+
+def forget_user():
+    session.pop(SNAPSHOT_KEY, None)
+
+
+def load_snapshot(user_id, profile_version) -> Optional[UserSnapshot]:
+    '''Snapshot for `user_id` from the session, or None if missing or stale.
+
+    `profile_version` is the user's current version in the database; a
+    snapshot taken at another version was written before the profile changed,
+    possibly from another device.
+    '''
+
+    stored = session.get(SNAPSHOT_KEY)
+    if not stored:
+        return None
+    try:
+        snapshot = UserSnapshot(*stored)
+    except TypeError:
+        return None
+    if snapshot.id != user_id or snapshot.profile_version != profile_version:
+        return None
+    return snapshot
@@ -0,0 +1,124 @@
+"""
+  In-memory sorted prefix index over usernames (typeahead)
+"""
+import threading
+import time
+from bisect import bisect_left, insort
+
+from sqlalchemy import DDL, event, select
+
+from models import db, User
+
+# let prefix LIKE queries use an index: SQLite's LIKE is case-insensitive and
+# needs a NOCASE index, PostgreSQL needs text_pattern_ops under non-C locales
+event.listen(
+    User.__table__, 'after_create',
+    DDL("CREATE INDEX IF NOT EXISTS ix_users_username_prefix "
+        "ON users (username COLLATE NOCASE)")
+    .execute_if(dialect='sqlite'))
+event.listen(
+    User.__table__, 'after_create',
+    DDL("CREATE INDEX IF NOT EXISTS ix_users_username_prefix "
+        "ON users (username text_pattern_ops)")
+    .execute_if(dialect='postgresql'))
+
+SEPARATOR = '\x00'
+
+
+def prefix_pattern(prefix: str):
+    '''LIKE pattern matching usernames starting with `prefix` (escape "\\").'''
+
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"{escaped}%"
+
+
+class UsernameIndex:
+    '''Sorted list of "lowercased username, username, id" keys searched with bisect.
+
+    Each worker keeps its own copy. Signups, renames and deletions made by
+    this worker are applied immediately; users created by other workers are
+    picked up every USERNAME_INDEX_TTL seconds by scanning ids above the
+    highest one a previous scan saw. Renames and deletions made by other
+    workers are not seen by that scan and stay stale until the whole index
+    is reloaded, every USERNAME_INDEX_REBUILD seconds.
+    '''
+
+    def __init__(self):
+        self._keys = []
+        self._lock = threading.Lock()
+        # highest id read from the database; local signups don't move it, so
+        # lower ids created meanwhile by other workers are still scanned
+        self._scanned_id = 0
+        self._checked_at = None
+        self._built_at = None
+        self.ttl = 60
+        self.rebuild_after = 3600
+
+    def init_app(self, app):
+        self.ttl = app.config.setdefault('USERNAME_INDEX_TTL', 60)
+        self.rebuild_after = app.config.setdefault('USERNAME_INDEX_REBUILD', 3600)
+
+    @staticmethod
+    def _key(user_id, username):
+        return f"{username.lower()}{SEPARATOR}{username}{SEPARATOR}{user_id}"
+
+    def warm(self):
+        '''(Re)load every username from the database.'''
+
+        rows = db.session.execute(select(User.id, User.username)).all()
+        keys = sorted(self._key(id, username) for id, username in rows)
+        with self._lock:
+            self._keys = keys
+            self._scanned_id = max((id for id, _ in rows), default=0)
+            self._built_at = self._checked_at = time.monotonic()
+
+    def _catch_up(self):
+        now = time.monotonic()
+        if self._built_at is None or now - self._built_at > self.rebuild_after:
+            self.warm()
+        elif now - self._checked_at > self.ttl:
+            new_users = db.session.execute(
+                select(User.id, User.username).where(User.id > self._scanned_id)).all()
+            for id, username in new_users:
+                self.add(id, username)
+            self._scanned_id = max((id for id, _ in new_users), default=self._scanned_id)
+            self._checked_at = now
+
+    def add(self, user_id, username):
+        key = self._key(user_id, username)
+        with self._lock:
+            position = bisect_left(self._keys, key)
+            if position == len(self._keys) or self._keys[position] != key:
+                insort(self._keys, key)
+
+    def remove(self, user_id, username):
+        key = self._key(user_id, username)
+        with self._lock:
+            position = bisect_left(self._keys, key)
+            if position < len(self._keys) and self._keys[position] == key:
+                del self._keys[position]
+
+    def rename(self, user_id, old_username, new_username):
+        if old_username != new_username:
+            self.remove(user_id, old_username)
+            self.add(user_id, new_username)
+
+    def search(self, prefix: str, limit=10):
+        '''Up to `limit` (id, username) pairs whose username starts with `prefix`.'''
+
+        self._catch_up()
+        prefix = prefix.lower()
+        results = []
+        with self._lock:
+            position = bisect_left(self._keys, prefix)
+            while len(results) < limit and position < len(self._keys):
+                key = self._keys[position]
+                if not key.startswith(prefix):
+                    break
+                _, username, id = key.split(SEPARATOR)
+                results.append((int(id), username))
+                position += 1
+        return results
+
+
+username_index = UsernameIndex()
@@ -0,0 +1,79 @@
+"""
+  Per-request state of the user looking at a page
+"""
+from flask import g
+from sqlalchemy import select
+
+from libs.block_filter import block_filter
+from models import db, Likes, User
+
+
+class ViewerContext:
+    '''Answers "is this mine?" and "did I like this?" for rendered messages.
+
+    Built once per request from the logged in user's id. Likes are fetched
+    only for the messages on the page (one query per `load_likes` call), so
+    the cost of rendering a timeline does not grow with the viewer's history.
+    Follow state is memoized the same way for user grids, and blocks are
+    checked against the viewer's cached block sets.
+    '''
+
+    def __init__(self, user_id=None):
+        self.user_id = user_id
+        self.liked_ids = set()
+        # user id -> does the viewer follow them; filled in batches
+        self.following = {}
+        self._blocks = None
+
+    def _load_blocks(self):
+        # who the viewer blocked or is blocked by, from the block filter cache
+        if self._blocks is None:
+            self._blocks = block_filter.for_user(g.user if self.user_id is not None else None)
+            self._hidden_ids = self._blocks.hidden
+
+    @property
+    def hidden_ids(self):
+        '''Ids of users the viewer blocked or is blocked by.'''
+
+        self._load_blocks()
+        return self._hidden_ids
+
+    def load_likes(self, messages):
+        '''Fetch which of `messages` the viewer has liked.'''
+
+        ids = [message.id for message in messages]
+        if self.user_id is None or not ids:
+            return
+        liked = select(Likes.message_id).where(
+            Likes.user_id == self.user_id,
+            Likes.message_id.in_(ids))
+        self.liked_ids.update(db.session.scalars(liked))
+
+    def load_following(self, users):
+        '''Fetch which of `users` the viewer follows, skipping ones already known.'''
+
+        ids = {user.id for user in users} - self.following.keys()
+        if self.user_id is None or not ids:
+            return
+        followed = User.followed_among(self.user_id, ids)
+        self.following.update((id, id in followed) for id in ids)
+
+    def is_following(self, user):
+        if user.id not in self.following:
+            self.load_following([user])
+        return self.following.get(user.id, False)
+
+    def owns(self, message):
+        return self.user_id is not None and message.user_id == self.user_id
+
+    def likes(self, message):
+        return message.id in self.liked_ids
+
+    def has_blocked(self, user):
+        self._load_blocks()
+        return user.id in self._blocks.blocked
+
+    def hides(self, user):
+        '''Is there a block between the viewer and `user`, in either direction?'''
+
+        return user.id in self.hidden_ids
@@ -2,14 +2,31 @@
 
 from datetime import datetime
 
+from flask import current_app
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import delete, exists, func, insert, literal, or_, select, true, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import joinedload, selectinload
+
+from libs.credentials import credentials
+from libs.pagination import before
+from libs.replicas import RoutingSession
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 migrate = Migrate(db)
 
+
+def insert_ignore(model):
+    """INSERT into `model`'s table that skips rows violating a unique constraint."""
+
+    if db.engine.dialect.name == 'sqlite':
+        return sqlite.insert(model).on_conflict_do_nothing()
+    return postgresql.insert(model).on_conflict_do_nothing()
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -27,9 +44,42 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key covers "who follows X"; this covers "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id', 'user_following_id'),
+    )
+
+    @classmethod
+    def forget_user(cls, user_id):
+        """Remove the follows of and by user `user_id`, keeping the other side's counts.
+
+        Call before deleting the user. Users they followed lose a follower and
+        their followers lose a followed user, each side in one UPDATE, so
+        neither relationship is loaded however many rows it has.
+        """
+
+        followed = select(cls.user_being_followed_id).where(cls.user_following_id == user_id)
+        db.session.execute(
+            update(User)
+            .where(User.id.in_(followed))
+            .values(followers_count=User.followers_count - 1),
+            execution_options={'synchronize_session': False})
+
+        followers = select(cls.user_following_id).where(cls.user_being_followed_id == user_id)
+        db.session.execute(
+            update(User)
+            .where(User.id.in_(followers))
+            .values(following_count=User.following_count - 1),
+            execution_options={'synchronize_session': False})
+
+        db.session.execute(
+            delete(cls).where(or_(cls.user_following_id == user_id,
+                                  cls.user_being_followed_id == user_id)),
+            execution_options={'synchronize_session': False})
+
 
 class Likes(db.Model):
-    """Mapping user likes to warbles."""
+    """Mapping user likes to warbles: each user likes a message at most once."""
 
     __tablename__ = 'likes' 
 
@@ -40,20 +90,101 @@ class Likes(db.Model):
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        nullable=False,
     )
 
+    # the unique constraint covers "what did X like"; this covers "who liked M"
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id', name='uq_likes_user_message'),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` as `user_id`, or take an existing like back.
+
+        Returns the change in the message's like count (1 or -1; 0 if a
+        concurrent request liked it first), or None if there is no such
+        message. An unlike is a single DELETE and a like a single
+        INSERT ... SELECT, so the user's likes are never loaded.
+        """
+
+        removed = db.session.execute(
+            delete(cls).where(cls.user_id == user_id, cls.message_id == message_id))
+        if removed.rowcount:
+            return -1
+
+        message = select(literal(user_id), Message.id).where(Message.id == message_id)
+        added = db.session.execute(
+            insert_ignore(cls).from_select(['user_id', 'message_id'], message))
+        if not added.rowcount and db.session.get(Message, message_id) is None:
+            return None
+        return added.rowcount
+
+    @classmethod
+    def forget_message(cls, message_id):
+        """Take the likes of message `message_id` off its likers' like counts.
+
+        Call before deleting the message: the database cascade removes its
+        likes, but not the counters of the users who liked it.
+        """
+
+        likers = select(cls.user_id).where(cls.message_id == message_id)
+        db.session.execute(
+            update(User)
+            .where(User.id.in_(likers))
+            .values(likes_count=User.likes_count - 1),
+            execution_options={'synchronize_session': False})
+
+    @classmethod
+    def forget_user(cls, user_id):
+        """Adjust like counts for the likes that go away with user `user_id`.
+
+        Call before deleting the user: the database cascade removes their
+        likes and the likes on their messages, but not the counters. Messages
+        they liked lose one like each, and users who liked their messages
+        lose those likes from their own count.
+        """
+
+        liked = select(cls.message_id).where(cls.user_id == user_id)
+        db.session.execute(
+            update(Message)
+            .where(Message.id.in_(liked))
+            .values(likes_count=Message.likes_count - 1),
+            execution_options={'synchronize_session': False})
+
+        on_their_messages = (select(cls.user_id)
+                             .join(Message, Message.id == cls.message_id)
+                             .where(Message.user_id == user_id, cls.user_id != user_id))
+        lost = (select(func.count())
+                .select_from(cls)
+                .join(Message, Message.id == cls.message_id)
+                .where(Message.user_id == user_id, cls.user_id == User.id)
+                .correlate(User)
+                .scalar_subquery())
+        db.session.execute(
+            update(User)
+            .where(User.id.in_(on_their_messages))
+            .values(likes_count=User.likes_count - lost),
+            execution_options={'synchronize_session': False})
+
 class Blocking(db.Model):
     __tablename__ = 'blocks'
     blocker_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), primary_key=True)
     blockee_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), primary_key=True)
 
+    # the primary key covers "who did X block"; this covers "who blocked X"
+    __table_args__ = (
+        db.Index('ix_blocks_blockee_id', 'blockee_id'),
+    )
+
 class User(db.Model):
     """User in the system."""
 
@@ -99,13 +230,14 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', back_populates='user')
+    messages = db.relationship('Message', back_populates='user', passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True
     )
 
     following = db.relationship(
@@ -113,7 +245,8 @@ class User(db.Model):
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
         secondaryjoin=(Follows.user_being_followed_id == id),
-        overlaps='followers'
+        overlaps='followers',
+        passive_deletes=True
     )
 
     likes = db.relationship(
@@ -127,6 +260,31 @@ class User(db.Model):
         default=False
     )
 
+    # denormalized counters, kept in step by the methods that change the
+    # underlying rows and recomputed in bulk by `User.reconcile_counts`
+    messages_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # pending follow requests received / sent
+    pending_requests_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    awaiting_requests_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # bumped whenever the profile shown on pages changes (username, images,
+    # bio, privacy...), so cached fragments and page ETags go stale
+    profile_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # bumped when a follow request or block involving the user is created or
+    # resolved; together with the counters it versions the user's pages
+    relations_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # authors with too many followers are not fanned out on write; their
+    # messages are pulled into followers' timelines at read time instead
+    timeline_pull = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False
+    )
+
     blocking_users = db.relationship(
         "User",
         secondary="blocks",
@@ -148,14 +306,35 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_use`?
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        A primary key lookup on `follows`; the relationship is not loaded.
+        """
+
+        found = exists().where(
+            Follows.user_being_followed_id == other_user.id,
+            Follows.user_following_id == self.id)
+        return db.session.scalar(select(found))
+
+    @classmethod
+    def followed_among(cls, follower_id, user_ids):
+        """Which of `user_ids` does `follower_id` follow? One query for the batch."""
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        followed = select(Follows.user_being_followed_id).where(
+            Follows.user_following_id == follower_id,
+            Follows.user_being_followed_id.in_(user_ids))
+        return set(db.session.scalars(followed))
+
+    def check_password(self, password):
+        """Does `password` match this user's hash? Runs on the credential pool."""
+
+        return credentials.check(self.password, password)
 
     def update_password(self, new_password):
         """Update password for user."""
@@ -165,54 +344,72 @@ class User(db.Model):
         if self.is_following(user):
             return False
         elif user.is_private:
-            has_pending_request = FollowRequest\
-                .query\
-                .filter(
-                    FollowRequest.user_being_followed_id==user.id, 
-                    FollowRequest.user_follow_id==self.id, 
-                    FollowRequest.status=='pending')\
-                .first()
-            
-            if not has_pending_request:
-                req = FollowRequest(
-                    user_being_followed_id=user.id, 
-                    user_follow_id=self.id)
-                db.session.add(req)
-                db.session.commit()
+            # a second request while one is pending hits the partial unique
+            # index and is skipped
+            created = db.session.execute(
+                insert_ignore(FollowRequest).values(
+                    user_being_followed_id=user.id,
+                    user_follow_id=self.id,
+                    status='pending',
+                    created_at=datetime.utcnow())).rowcount
+            if created:
+                User.adjust_counts(self.id, awaiting_requests_count=1, relations_version=1)
+                User.adjust_counts(user.id, pending_requests_count=1, relations_version=1)
+            db.session.commit()
             return True
         else:
-            self.following.append(user)
+            # inserted directly so neither side's follow lists are loaded; a
+            # concurrent follow of the same user is skipped by the primary key
+            added = db.session.execute(
+                insert_ignore(Follows).values(
+                    user_being_followed_id=user.id,
+                    user_following_id=self.id)).rowcount
+            if added:
+                User.adjust_counts(self.id, following_count=1)
+                User.adjust_counts(user.id, followers_count=1)
+                TimelineEntry.backfill(self.id, user.id)
             db.session.commit()
             return True
+
+    def unfollow(self, user: 'User'):
+        removed = db.session.execute(
+            delete(Follows).where(Follows.user_following_id == self.id,
+                                  Follows.user_being_followed_id == user.id)).rowcount
+        if not removed:
+            return False
+        User.adjust_counts(self.id, following_count=-1)
+        User.adjust_counts(user.id, followers_count=-1)
+        TimelineEntry.remove_author(self.id, user.id)
+        db.session.commit()
+        return True
+
     def accept_request(self, request_id):
-        req: FollowRequest = db.session.query(FollowRequest).filter(
-            FollowRequest.id == request_id, 
-            FollowRequest.user_being_followed_id == self.id, 
-            FollowRequest.status == 'pending').first()
+        req = FollowRequest.resolve(
+            request_id, FollowRequest.user_being_followed_id == self.id, 'accepted')
         if not req:
-            return False 
-        req.status = 'accepted'
-        self.followers.append(req.requester)
+            return False
+        added = db.session.execute(
+            insert_ignore(Follows).values(
+                user_being_followed_id=self.id,
+                user_following_id=req.user_follow_id)).rowcount
+        if added:
+            User.adjust_counts(self.id, followers_count=1)
+            User.adjust_counts(req.user_follow_id, following_count=1)
+            TimelineEntry.backfill(req.user_follow_id, self.id)
         db.session.commit()
         return True
     def deny_request(self, request_id):
-        req: FollowRequest = db.session.query(FollowRequest).filter(
-            FollowRequest.id == request_id, 
-            FollowRequest.user_being_followed_id == self.id, 
-            FollowRequest.status == 'pending').first()
+        req = FollowRequest.resolve(
+            request_id, FollowRequest.user_being_followed_id == self.id, 'denied')
         if not req:
-            return False 
-        req.status = 'denied'
+            return False
         db.session.commit()
         return True
     def cancel_request(self, request_id):
-        req: FollowRequest = db.session.query(FollowRequest).filter(
-            FollowRequest.id == request_id, 
-            FollowRequest.user_follow_id == self.id, 
-            FollowRequest.status == 'pending').first()
+        req = FollowRequest.resolve(
+            request_id, FollowRequest.user_follow_id == self.id, 'canceled')
         if not req:
-            return False 
-        req.status = 'canceled'
+            return False
         db.session.commit()
         return True
 
@@ -221,6 +418,7 @@ class User(db.Model):
             return False
         if user not in self.blocked_users:
             self.blocked_users.append(user)
+            User.touch_relations(self.id, user.id)
             db.session.commit()
             return True
         return False
@@ -230,10 +428,55 @@ class User(db.Model):
             return False
         if user in self.blocked_users:
             self.blocked_users.remove(user)
+            User.touch_relations(self.id, user.id)
             db.session.commit()
             return True
         return True
 
+    @classmethod
+    def adjust_counts(cls, user_id, **deltas):
+        """Add `deltas` to counter columns of `user_id` in the current transaction.
+
+        The increment happens in SQL (`count = count + delta`), so concurrent
+        writers never overwrite each other's changes.
+        """
+
+        db.session.execute(
+            update(cls)
+            .where(cls.id == user_id)
+            .values({getattr(cls, name): getattr(cls, name) + delta
+                     for name, delta in deltas.items()}))
+
+    @classmethod
+    def touch_relations(cls, *user_ids):
+        """Bump `relations_version` of every user in `user_ids`."""
+
+        for user_id in user_ids:
+            cls.adjust_counts(user_id, relations_version=1)
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counters from the underlying tables."""
+
+        def count(key, *criteria):
+            return (select(func.count())
+                    .where(key == cls.id, *criteria)
+                    .correlate(cls)
+                    .scalar_subquery())
+
+        db.session.execute(
+            update(cls).values(
+                messages_count=count(Message.user_id),
+                following_count=count(Follows.user_following_id),
+                followers_count=count(Follows.user_being_followed_id),
+                likes_count=count(Likes.user_id),
+                pending_requests_count=count(FollowRequest.user_being_followed_id,
+                                             FollowRequest.status == 'pending'),
+                awaiting_requests_count=count(FollowRequest.user_follow_id,
+                                              FollowRequest.status == 'pending'),
+            ),
+            execution_options={'synchronize_session': False})
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -262,14 +505,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        Hashes made with an outdated work factor are upgraded to the current
+        BCRYPT_LOG_ROUNDS on successful login.
         """
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            if credentials.needs_rehash(user.password):
+                user.update_password(password)
+                db.session.commit()
+            return user
 
         return False
 
@@ -292,7 +539,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -303,15 +550,375 @@ class Message(db.Model):
 
     user = db.relationship('User', back_populates='messages')
 
+    # applied in batches by libs/like_counter.py, so it may trail the likes
+    # table by a few seconds; `Message.reconcile_likes` recomputes it
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+    @staticmethod
+    def with_author():
+        """Loader option batch-loading the authors of a list of messages.
+
+        Authors are fetched with one `IN (...)` query per result list instead
+        of a lazy load per rendered message; the session identity map (scoped
+        to the request) makes sure each author is hydrated only once.
+        """
+
+        return selectinload(Message.user)
+
+    @classmethod
+    def for_user(cls, user_id, limit=100, cursor=None):
+        """Newest `limit` messages of `user_id` older than `cursor`."""
+
+        return (cls
+                .query
+                .options(cls.with_author())
+                .filter(cls.user_id == user_id,
+                        before(cls.timestamp, cls.id, cursor))
+                .order_by(cls.timestamp.desc(), cls.id.desc())
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def reconcile_likes(cls):
+        """Recompute every message's like count from the likes table."""
+
+        count = (select(func.count())
+                 .where(Likes.message_id == cls.id)
+                 .correlate(cls)
+                 .scalar_subquery())
+        db.session.execute(update(cls).values(likes_count=count),
+                           execution_options={'synchronize_session': False})
+
+    @classmethod
+    def liked_by(cls, user_id):
+        """Messages liked by `user_id`, most recently liked first."""
+
+        return (cls
+                .query
+                .options(cls.with_author())
+                .join(Likes, Likes.message_id == cls.id)
+                .filter(Likes.user_id == user_id)
+                .order_by(Likes.id.desc())
+                .all())
+
 class FollowRequest(db.Model):
+    """A request to follow a private account.
+
+    Only pending requests are shown; accepted, denied and canceled ones are
+    kept for a while and then moved to `follow_requests_archive` by
+    `flask archive-follow-requests`.
+    """
+
     __tablename__ = 'follow_requests'
     id = db.Column(db.Integer, primary_key=True)
     user_being_followed_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'))
     user_follow_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    requester = db.relationship('User', backref="awaiting_requests", foreign_keys=[user_follow_id])
-    requestee = db.relationship('User', foreign_keys=[user_being_followed_id], backref="pending_requests")
-    status = db.Column(db.String, default='pending')
+    resolved_at = db.Column(db.DateTime)
+    requester = db.relationship('User', foreign_keys=[user_follow_id],
+                                backref=db.backref("awaiting_requests", passive_deletes=True))
+    requestee = db.relationship('User', foreign_keys=[user_being_followed_id],
+                                backref=db.backref("pending_requests", passive_deletes=True))
+    status = db.Column(db.String, nullable=False, default='pending')
+
+    __table_args__ = (
+        # a user's received / sent requests in a given status, newest first
+        db.Index('ix_follow_requests_followed_status', 'user_being_followed_id', 'status', 'id'),
+        db.Index('ix_follow_requests_follower_status', 'user_follow_id', 'status', 'id'),
+        # one pending request per pair; `User.follow` inserts against it
+        db.Index('uq_follow_requests_pending', 'user_follow_id', 'user_being_followed_id',
+                 unique=True,
+                 postgresql_where=db.text("status = 'pending'"),
+                 sqlite_where=db.text("status = 'pending'")),
+    )
+
+    @classmethod
+    def received(cls, user_id, limit, before_id=None):
+        """Pending requests sent to `user_id`, newest first, with their requesters."""
+
+        return cls._pending(cls.user_being_followed_id == user_id, cls.requester,
+                            limit, before_id)
+
+    @classmethod
+    def sent(cls, user_id, limit, before_id=None):
+        """Pending requests sent by `user_id`, newest first, with their requestees."""
+
+        return cls._pending(cls.user_follow_id == user_id, cls.requestee, limit, before_id)
+
+    @classmethod
+    def _pending(cls, owner, other, limit, before_id):
+        query = cls.query.options(joinedload(other)).filter(owner, cls.status == 'pending')
+        if before_id is not None:
+            query = query.filter(cls.id < before_id)
+        return query.order_by(cls.id.desc()).limit(limit).all()
+
+    @classmethod
+    def resolve(cls, request_id, owner, status):
+        """Set the status of pending request `request_id`, if `owner` (a
+        criterion on the request's users) matches it; returns the request.
+
+        The change is a conditional UPDATE, so of two concurrent attempts to
+        resolve the same request only one succeeds and adjusts the counters.
+        """
+
+        req = db.session.query(cls).filter(cls.id == request_id, owner).first()
+        if req is None:
+            return None
+        resolved = db.session.execute(
+            update(cls)
+            .where(cls.id == request_id, cls.status == 'pending')
+            .values(status=status, resolved_at=datetime.utcnow()),
+            execution_options={'synchronize_session': 'fetch'}).rowcount
+        if not resolved:
+            return None
+        User.adjust_counts(req.user_being_followed_id, pending_requests_count=-1,
+                           relations_version=1)
+        User.adjust_counts(req.user_follow_id, awaiting_requests_count=-1,
+                           relations_version=1)
+        return req
+
+    @classmethod
+    def forget_user(cls, user_id):
+        """Take the pending requests of user `user_id` off the other side's
+        counters; call before deleting the user, whose requests go with them."""
+
+        pending = cls.status == 'pending'
+        for other, own, counter in (
+                (cls.user_being_followed_id, cls.user_follow_id, 'pending_requests_count'),
+                (cls.user_follow_id, cls.user_being_followed_id, 'awaiting_requests_count')):
+            db.session.execute(
+                update(User)
+                .where(User.id.in_(select(other).where(own == user_id, pending)))
+                .values({getattr(User, counter): getattr(User, counter) - 1,
+                         User.relations_version: User.relations_version + 1}),
+                execution_options={'synchronize_session': False})
+
+    @classmethod
+    def archive_resolved(cls, older_than, batch_size=1000):
+        """Move requests resolved before `older_than` to the archive table.
+
+        Each batch is copied and deleted in its own transaction, so a large
+        backlog never holds locks for long. Returns the number of rows moved.
+        """
+
+        columns = ['id', 'user_being_followed_id', 'user_follow_id', 'status',
+                   'created_at', 'resolved_at']
+        moved = 0
+        while True:
+            ids = db.session.scalars(
+                select(cls.id)
+                .where(cls.status != 'pending',
+                       func.coalesce(cls.resolved_at, cls.created_at) < older_than)
+                .order_by(cls.id)
+                .limit(batch_size)).all()
+            if not ids:
+                return moved
+            db.session.execute(
+                insert(ArchivedFollowRequest).from_select(
+                    columns,
+                    select(*[getattr(cls, column) for column in columns])
+                    .where(cls.id.in_(ids))))
+            db.session.execute(delete(cls).where(cls.id.in_(ids)),
+                               execution_options={'synchronize_session': False})
+            db.session.commit()
+            moved += len(ids)
+
+
+class ArchivedFollowRequest(db.Model):
+    """An accepted, denied or canceled follow request, out of the hot table."""
+
+    __tablename__ = 'follow_requests_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_being_followed_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'))
+    user_follow_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'))
+    status = db.Column(db.String, nullable=False)
+    created_at = db.Column(db.DateTime)
+    resolved_at = db.Column(db.DateTime)
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Messages are pushed into every follower's timeline when they are posted
+    (fan-out-on-write), so the home page reads one index range instead of
+    sorting the messages of everyone the user follows. Authors whose follower
+    count reaches TIMELINE_FANOUT_LIMIT are switched to pull mode: their
+    messages are merged in at read time.
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_timestamp', 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timelines_user_author', 'user_id', 'author_id'),
+        db.Index('ix_timelines_message_id', 'message_id'),
+    )
+
+    BACKFILL_SIZE = 100
+
+    @staticmethod
+    def fanout_limit():
+        return current_app.config.get('TIMELINE_FANOUT_LIMIT', 10000)
+
+    @classmethod
+    def fan_out(cls, message: 'Message'):
+        """Push a freshly flushed message into its author's and followers' timelines."""
+
+        db.session.add(cls(
+            user_id=message.user_id,
+            message_id=message.id,
+            author_id=message.user_id,
+            timestamp=message.timestamp))
+
+        author: User = message.user
+        if author.followers_count >= cls.fanout_limit():
+            author.timeline_pull = True
+        if author.timeline_pull:
+            return
+
+        followers = select(
+            Follows.user_following_id,
+            literal(message.id),
+            literal(message.user_id),
+            literal(message.timestamp, db.DateTime),
+        ).where(Follows.user_being_followed_id == message.user_id)
+        db.session.execute(
+            insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'], followers))
+
+    @classmethod
+    def backfill(cls, user_id, author_id):
+        """Copy the newest messages of `author_id` into the timeline of `user_id`."""
+
+        db.session.execute(
+            delete(cls).where(cls.user_id == user_id, cls.author_id == author_id))
+        recent = (select(
+                    literal(user_id),
+                    Message.id,
+                    Message.user_id,
+                    Message.timestamp)
+                  .where(Message.user_id == author_id)
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(cls.BACKFILL_SIZE))
+        db.session.execute(
+            insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'], recent))
+
+    @classmethod
+    def remove_author(cls, user_id, author_id):
+        """Drop every message of `author_id` from the timeline of `user_id` (unfollow)."""
+
+        db.session.execute(
+            delete(cls).where(cls.user_id == user_id, cls.author_id == author_id))
+
+    @classmethod
+    def remove_message(cls, message_id):
+        """Drop a message from every timeline it was pushed to."""
+
+        db.session.execute(delete(cls).where(cls.message_id == message_id))
+
+    @classmethod
+    def home_messages(cls, user: User, limit=100, cursor=None, hidden=frozenset()):
+        """Newest `limit` messages for the home timeline of `user` older than `cursor`,
+        leaving out authors in `hidden` (see libs/block_filter.py)."""
+
+        pushed = (db.session.query(Message)
+                  .options(Message.with_author())
+                  .join(cls, cls.message_id == Message.id)
+                  .filter(cls.user_id == user.id,
+                          cls.author_id.notin_(hidden) if hidden else true(),
+                          before(cls.timestamp, cls.message_id, cursor))
+                  .order_by(cls.timestamp.desc(), cls.message_id.desc())
+                  .limit(limit)
+                  .all())
+
+        pull_authors = (select(Follows.user_being_followed_id)
+                        .join(User, User.id == Follows.user_being_followed_id)
+                        .where(Follows.user_following_id == user.id,
+                               User.timeline_pull.is_(True)))
+        pulled = (Message
+                  .query
+                  .options(Message.with_author())
+                  .filter(Message.user_id.in_(pull_authors),
+                          Message.user_id.notin_(hidden) if hidden else true(),
+                          before(Message.timestamp, Message.id, cursor))
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(limit)
+                  .all())
+        if not pulled:
+            return pushed
+
+        merged = {message.id: message for message in pushed + pulled}
+        return sorted(merged.values(),
+                      key=lambda message: (message.timestamp, message.id),
+                      reverse=True)[:limit]
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every timeline from `messages` and `follows` in bulk.
+
+        Each followed push-mode author contributes their newest BACKFILL_SIZE
+        messages, as a live follow does (see `backfill`), so the table grows
+        with the number of follows rather than follows times messages.
+        Relies on up-to-date follower counters; run `User.reconcile_counts` first.
+        """
+
+        db.session.execute(
+            update(User).values(
+                timeline_pull=User.followers_count >= cls.fanout_limit()),
+            execution_options={'synchronize_session': False})
+
+        db.session.execute(delete(cls))
+        columns = ['user_id', 'message_id', 'author_id', 'timestamp']
+        own = select(Message.user_id, Message.id, Message.user_id, Message.timestamp)
+        db.session.execute(insert(cls).from_select(columns, own))
+        # the newest messages of each author are the same for all followers
+        newest = (select(
+                      Message.id,
+                      Message.user_id,
+                      Message.timestamp,
+                      func.row_number().over(
+                          partition_by=Message.user_id,
+                          order_by=(Message.timestamp.desc(), Message.id.desc()),
+                      ).label('position'))
+                  .join(User, User.id == Message.user_id)
+                  .where(User.timeline_pull.is_(False))
+                  .subquery())
+        followed = (select(
+                        Follows.user_following_id,
+                        newest.c.id,
+                        newest.c.user_id,
+                        newest.c.timestamp)
+                    .join(Follows, Follows.user_being_followed_id == newest.c.user_id)
+                    .where(newest.c.position <= cls.BACKFILL_SIZE))
+        db.session.execute(insert(cls).from_select(columns, followed))
 
 
 def connect_db(app):
@@ -322,4 +929,6 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
+    credentials.init_app(app)
     migrate.init_app(app, db)
\ No newline at end of file
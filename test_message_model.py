@@ -1,11 +1,12 @@
 from unittest import TestCase
-from models import db, Message, User
+from models import db, Likes, Message, User
 from sqlalchemy.exc import IntegrityError
 from os import environ
 from datetime import datetime
 
 environ['DATABASE_URL'] = 'sqlite:///:memory:'
 from app import app
+from libs.like_counter import like_counter
 
 with app.app_context(): 
   db.create_all()
@@ -13,6 +14,8 @@ with app.app_context():
 class MessageModelTest(TestCase):
   def setUp(self) -> None:
     with app.app_context():
+      like_counter.flush()
+      Likes.query.delete()
       Message.query.delete()
       User.query.delete()
 
@@ -37,3 +40,34 @@ class MessageModelTest(TestCase):
       self.assertEqual(message.user, self.user)
       self.assertEqual(message.id, 1)
       self.assertEqual(message.timestamp.date(), datetime.utcnow().date())
+
+
+  def test_likes_toggle_and_count(self):
+    with app.app_context():
+      other = User(username='other', email='other@test.com', password='HASHED_PASSWORD')
+      message = Message(text='popular', user=self.user)
+      db.session.add_all([other, message])
+      db.session.commit()
+      user_id = db.session.merge(self.user).id
+
+      # any number of users can like the same message
+      for liker in (user_id, other.id):
+        change = Likes.toggle(liker, message.id)
+        self.assertEqual(change, 1)
+        like_counter.add(message.id, change)
+      db.session.commit()
+      self.assertEqual(Likes.query.filter_by(message_id=message.id).count(), 2)
+
+      # counts are written behind, in one batch
+      self.assertEqual(like_counter.pending(message.id), 2)
+      self.assertEqual(like_counter.flush(), 1)
+      db.session.refresh(message)
+      self.assertEqual(message.likes_count, 2)
+
+      self.assertEqual(Likes.toggle(other.id, message.id), -1)
+      self.assertEqual(Likes.toggle(other.id, 0), None)
+      db.session.commit()
+      Message.reconcile_likes()
+      db.session.commit()
+      db.session.refresh(message)
+      self.assertEqual(message.likes_count, 1)
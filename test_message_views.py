@@ -5,10 +5,27 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+import asyncio
+import json
 import os
+import shutil
+import tempfile
+from datetime import datetime
 from unittest import TestCase
-from flask import session
-from models import db, connect_db, Message, User
+from flask import Flask, session, url_for
+from sqlalchemy import create_engine, insert, update
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import Session
+from models import db, connect_db, Blocking, Message, User, Likes, Follows, TimelineEntry
+from libs.pagination import Cursor
+from libs.query_stats import query_budget
+from libs.fragment_cache import fragment_cache
+from libs.like_counter import like_counter
+from libs.block_filter import block_filter
+from libs.metrics import REQUESTS
+from libs.user_snapshot import profile_versions
+from libs.assets import Assets, build_assets
+import api
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +38,7 @@ os.environ['DATABASE_URL'] = "sqlite:///:memory:"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from asgi import AsyncReads, async_url
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -40,8 +58,15 @@ class MessageViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
         with app.app_context():
+            like_counter.flush()
+            block_filter.clear()
+            profile_versions.clear()
+            Blocking.query.delete()
             User.query.delete()
             Message.query.delete()
+            Likes.query.delete()
+            Follows.query.delete()
+            TimelineEntry.query.delete()
 
             self.client = app.test_client()
 
@@ -100,3 +125,480 @@ class MessageViewTestCase(TestCase):
 
             res = client.post(f'/messages/{msg_id}/delete')
             self.assertEqual(res.status_code, 401)
+
+    def test_profile_pagination(self):
+        with app.app_context():
+            for i in range(3):
+                db.session.add(Message(text=f'message {i}', user_id=self.testuser.id,
+                                       timestamp=datetime(2023, 1, 1 + i)))
+            db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            res = client.get(f'/users/{self.testuser.id}?limit=2')
+            html = res.get_data(as_text=True)
+            self.assertIn('message 2', html)
+            self.assertIn('message 1', html)
+            self.assertNotIn('message 0', html)
+            self.assertIn('Load more', html)
+
+            cursor = Cursor(datetime(2023, 1, 2), Message.query.filter_by(text='message 1').one().id)
+            res = client.get(f'/users/{self.testuser.id}?limit=2&before={cursor.encode()}')
+            html = res.get_data(as_text=True)
+            self.assertIn('message 0', html)
+            self.assertNotIn('message 1', html)
+            self.assertNotIn('Load more', html)
+
+            # ids past BIGINT are malformed cursors, not driver errors
+            res = client.get(f'/users/{self.testuser.id}?limit=2'
+                             f'&before=2023-01-01T00:00:00_99999999999999999999')
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('message 2', res.get_data(as_text=True))
+
+    def test_show_message_viewer_state(self):
+        with app.app_context():
+            msg = Message(text='liked message', user_id=self.testuser.id)
+            db.session.add(msg)
+            db.session.commit()
+            msg_id = msg.id
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            html = client.get(f'/messages/{msg_id}').get_data(as_text=True)
+            self.assertIn('btn-outline-secondary', html)
+            self.assertIn(f'/messages/{msg_id}/delete', html)
+
+            client.post(f'/users/add_like/{msg_id}')
+            html = client.get(f'/messages/{msg_id}').get_data(as_text=True)
+            self.assertIn('btn-outline-primary', html)
+            self.assertEqual(client.post('/users/add_like/0').status_code, 404)
+
+            like_counter.flush()
+            with app.app_context():
+                self.assertEqual(db.session.get(Message, msg_id).likes_count, 1)
+
+        with app.test_client() as anonymous:
+            html = anonymous.get(f'/messages/{msg_id}').get_data(as_text=True)
+            self.assertNotIn(f'/messages/{msg_id}/delete', html)
+
+    def test_deleting_user_fixes_like_counts(self):
+        with app.app_context():
+            other = User(username='other', email='other@test.com', password='x')
+            db.session.add(other)
+            db.session.commit()
+            other_id = other.id
+            mine = Message(text='mine', user_id=self.testuser.id)
+            theirs = Message(text='theirs', user_id=other_id)
+            db.session.add_all([mine, theirs])
+            db.session.commit()
+            mine_id, theirs_id = mine.id, theirs.id
+            me = db.session.get(User, self.testuser.id)
+            me.follow(other)
+            other.follow(me)
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            client.post(f'/users/add_like/{mine_id}')
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            client.post(f'/users/add_like/{theirs_id}')
+            like_counter.flush()
+
+            client.post('/users/delete')
+
+        with app.app_context():
+            self.assertEqual(db.session.get(Message, theirs_id).likes_count, 0)
+            other = db.session.get(User, other_id)
+            self.assertEqual(other.likes_count, 0)
+            self.assertEqual((other.followers_count, other.following_count), (0, 0))
+            self.assertEqual(Follows.query.count(), 0)
+
+    def test_deleting_message_fixes_like_counts(self):
+        with app.app_context():
+            other = User(username='other', email='other@test.com', password='x')
+            msg = Message(text='mine', user_id=self.testuser.id)
+            db.session.add_all([other, msg])
+            db.session.commit()
+            other_id, msg_id = other.id, msg.id
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            client.post(f'/users/add_like/{msg_id}')
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            client.post(f'/messages/{msg_id}/delete')
+
+        with app.app_context():
+            self.assertEqual(db.session.get(User, other_id).likes_count, 0)
+
+    def test_search_messages(self):
+        with app.app_context():
+            db.session.add_all([
+                Message(text='the quick brown fox', user_id=self.testuser.id),
+                Message(text='a lazy dog', user_id=self.testuser.id),
+            ])
+            db.session.commit()
+
+        with self.client as client:
+            html = client.get('/messages/search?q=fox').get_data(as_text=True)
+            self.assertIn('the quick brown fox', html)
+            self.assertNotIn('a lazy dog', html)
+
+            html = client.get('/messages/search?q="OR').get_data(as_text=True)
+            self.assertIn('No warbles match', html)
+
+    def test_hot_routes_query_budget(self):
+        """Statement counts stay flat however many authors and likes a page shows."""
+
+        with app.app_context():
+            authors = [User.signup(username=f'author{i}', email=f'author{i}@test.com',
+                                   password='password', image_url=None) for i in range(5)]
+            db.session.commit()
+            author_ids = [author.id for author in authors]
+            me = db.session.get(User, self.testuser.id)
+            for author in authors:
+                me.follow(author)
+
+        with self.client as client:
+            for author_id in author_ids:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = author_id
+                client.post('/messages/new', data={'text': f'hello from {author_id}'})
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            msg_ids = [id for id, in db.session.query(Message.id)]
+            for msg_id in msg_ids:
+                client.post(f'/users/add_like/{msg_id}')
+
+            with query_budget(6):
+                res = client.get('/')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers['X-DB-Queries'], '6')
+            self.assertIn('db;dur=', res.headers['Server-Timing'])
+            # the viewer's block set is cached after the first page
+            self.assertEqual(client.get('/').headers['X-DB-Queries'], '5')
+
+            with query_budget(9):
+                self.assertEqual(client.get(f'/users/{author_ids[0]}').status_code, 200)
+            with query_budget(9):
+                self.assertEqual(client.get(f'/users/{self.testuser.id}/likes').status_code, 200)
+            with query_budget(4):
+                self.assertEqual(client.get(f'/messages/{msg_ids[0]}').status_code, 200)
+            with query_budget(8):
+                self.assertEqual(client.post('/messages/new', data={'text': 'hi'}).status_code, 302)
+
+            with self.assertRaises(AssertionError):
+                with query_budget(1):
+                    client.get('/')
+
+    def test_message_fragment_cache(self):
+        with app.app_context():
+            msg = Message(text='cached message', user_id=self.testuser.id)
+            db.session.add(msg)
+            db.session.commit()
+            msg_id = msg.id
+        fragment_cache.clear()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            client.get(f'/messages/{msg_id}')
+            misses = fragment_cache.misses
+            html = client.get(f'/messages/{msg_id}').get_data(as_text=True)
+            self.assertEqual(fragment_cache.misses, misses)
+            self.assertIn('btn-outline-secondary', html)
+
+            # liking renders (and caches) another variant
+            client.post(f'/users/add_like/{msg_id}')
+            html = client.get(f'/messages/{msg_id}').get_data(as_text=True)
+            self.assertEqual(fragment_cache.misses, misses + 1)
+            self.assertIn('btn-outline-primary', html)
+
+            # a new username changes the author's profile version
+            user = db.session.get(User, self.testuser.id)
+            user.username = 'renamed'
+            user.profile_version += 1
+            db.session.commit()
+            html = client.get(f'/messages/{msg_id}').get_data(as_text=True)
+            self.assertIn('@renamed', html)
+
+            client.post(f'/messages/{msg_id}/delete')
+            self.assertNotIn(msg_id, {key[0] for key in fragment_cache._entries})
+
+    def test_conditional_get(self):
+        with app.app_context():
+            msg = Message(text='etag message', user_id=self.testuser.id)
+            db.session.add(msg)
+            db.session.commit()
+            msg_id = msg.id
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            res = client.get(f'/users/{self.testuser.id}')
+            etag = res.headers['ETag']
+            self.assertTrue(etag.startswith('W/'))
+            self.assertEqual(res.headers['Cache-Control'], 'private, no-cache')
+
+            res = client.get(f'/users/{self.testuser.id}', headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(res.get_data(), b'')
+
+            # liking a message on the page changes it
+            client.post(f'/users/add_like/{msg_id}')
+            res = client.get(f'/users/{self.testuser.id}', headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 200)
+
+            # pages with pending flashes are always rendered
+            self.assertNotIn('ETag', res.headers)
+
+            # another viewer never gets the first viewer's copy
+            etag = client.get(f'/users/{self.testuser.id}').headers['ETag']
+            with app.test_client() as anonymous:
+                res = anonymous.get(f'/users/{self.testuser.id}', headers={'If-None-Match': etag})
+                self.assertEqual(res.status_code, 200)
+
+    def test_static_files_versioned(self):
+        with app.test_request_context():
+            url = url_for('static', filename='stylesheets/style.css')
+        # ?v=<hash> before `python -m libs.assets` has run, /static/dist/ after
+        self.assertRegex(url, r'\?v=|/static/dist/')
+        res = self.client.get(url)
+        self.assertEqual(res.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        res.close()
+
+        res = self.client.get('/static/stylesheets/style.css?v=0123456789ab')
+        self.assertNotIn('immutable', res.headers.get('Cache-Control', ''))
+        res.close()
+
+    def test_built_assets(self):
+        static = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(static, 'images'))
+            with open(os.path.join(static, 'images', 'logo.png'), 'wb') as image:
+                image.write(b'not really a png')
+            with open(os.path.join(static, 'site.css'), 'w') as css:
+                css.write('/* header */\nbody {\n  background: url("/static/images/logo.png");\n}\n')
+            manifest = build_assets(static)
+
+            site = Flask(__name__, static_folder=static, static_url_path='/static')
+            Assets(site)
+            with site.test_request_context():
+                css_url = url_for('static', filename='site.css')
+                self.assertEqual(css_url, f"/static/dist/{manifest['site.css']}")
+                self.assertEqual(site.jinja_env.filters['asset']('/static/images/logo.png'),
+                                 f"/static/dist/{manifest['images/logo.png']}")
+                self.assertEqual(site.jinja_env.filters['asset']('https://example.com/a.png'),
+                                 'https://example.com/a.png')
+
+            client = site.test_client()
+            res = client.get(css_url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(res.mimetype, 'text/css')
+            self.assertEqual(res.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+            self.assertIn('Accept-Encoding', res.headers['Vary'])
+            res.close()
+
+            res = client.get(css_url)
+            self.assertNotIn('Content-Encoding', res.headers)
+            self.assertEqual(res.get_data(as_text=True),
+                             f'body{{background:url("/static/dist/{manifest["images/logo.png"]}")}}')
+            res.close()
+        finally:
+            shutil.rmtree(static)
+
+    def test_api_user_messages(self):
+        with app.app_context():
+            for i in range(3):
+                db.session.add(Message(text=f'api message {i}', user_id=self.testuser.id,
+                                       timestamp=datetime(2023, 1, 1 + i)))
+            db.session.commit()
+
+        with self.client as client:
+            res = client.get(f'/api/v1/users/{self.testuser.id}/messages?limit=2')
+            self.assertEqual(res.mimetype, 'application/json')
+            page = res.json
+            self.assertEqual([item['text'] for item in page['items']], ['api message 2', 'api message 1'])
+            self.assertEqual(page['items'][0]['user']['username'], 'testuser')
+            self.assertEqual(page['items'][0]['timestamp'], '2023-01-03T00:00:00')
+
+            page = client.get(f'/api/v1/users/{self.testuser.id}/messages?limit=2'
+                              f'&before={page["next_cursor"]}').json
+            self.assertEqual([item['text'] for item in page['items']], ['api message 0'])
+            self.assertIsNone(page['next_cursor'])
+
+            self.assertEqual(client.get('/api/v1/users/0/messages').status_code, 404)
+            self.assertEqual(client.get('/api/v1/timeline').status_code, 401)
+            res = client.get(f'/api/v1/users/{self.testuser.id}/likes?before=99999999999999999999')
+            self.assertEqual(res.status_code, 200)
+
+    def test_api_ndjson_stream(self):
+        with app.app_context():
+            db.session.add_all([Message(text=f'streamed {i}', user_id=self.testuser.id)
+                                for i in range(5)])
+            db.session.commit()
+
+        app.config['API_STREAM_BATCH'] = 2
+        try:
+            with self.client as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+                res = client.get(f'/api/v1/users/{self.testuser.id}/messages',
+                                 headers={'Accept': 'application/x-ndjson'})
+                self.assertEqual(res.mimetype, 'application/x-ndjson')
+                lines = res.get_data(as_text=True).splitlines()
+                self.assertEqual(len(lines), 5)
+                self.assertEqual(len({line for line in lines}), 5)
+
+                client.post('/messages/new', data={'text': 'fanned out'})
+                lines = client.get('/api/v1/timeline?format=ndjson').get_data(as_text=True).splitlines()
+                self.assertEqual(len(lines), 1)
+                self.assertIn('fanned out', lines[0])
+        finally:
+            app.config['API_STREAM_BATCH'] = 1000
+
+    def test_api_private_user(self):
+        with app.app_context():
+            user = db.session.get(User, self.testuser.id)
+            user.is_private = True
+            db.session.commit()
+
+        with app.test_client() as anonymous:
+            res = anonymous.get(f'/api/v1/users/{self.testuser.id}/likes')
+            self.assertEqual(res.status_code, 403)
+            self.assertEqual(res.json, {'error': 'this account is private'})
+
+    def test_api_hides_blocked_users(self):
+        with app.app_context():
+            author = User(username='author', email='author@test.com', password='x')
+            db.session.add(author)
+            db.session.commit()
+            author_id = author.id
+            me = db.session.get(User, self.testuser.id)
+            me.follow(author)
+            msg = Message(text='blocked message', user_id=author_id)
+            db.session.add(msg)
+            db.session.commit()
+            TimelineEntry.fan_out(msg)
+            Likes.toggle(self.testuser.id, msg.id)
+            db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            self.assertEqual(len(client.get('/api/v1/timeline').json['items']), 1)
+
+            with app.app_context():
+                db.session.get(User, author_id).block(db.session.get(User, self.testuser.id))
+
+            res = client.get(f'/api/v1/users/{author_id}/messages')
+            self.assertEqual(res.status_code, 404)
+            self.assertEqual(client.get(f'/api/v1/users/{author_id}/likes').status_code, 404)
+            self.assertEqual(client.get('/api/v1/timeline').json['items'], [])
+            self.assertEqual(
+                client.get(f'/api/v1/users/{self.testuser.id}/likes').json['items'], [])
+            self.assertEqual(
+                client.get(f'/api/v1/users/{self.testuser.id}/following').json['items'], [])
+
+        # follower lists need a login, as on /users/<id>/followers
+        self.assertEqual(app.test_client().get(
+            f'/api/v1/users/{self.testuser.id}/following').status_code, 401)
+
+    def test_api_json_fallback_matches_orjson(self):
+        value = {'text': 'é', 'timestamp': datetime(2023, 1, 2, 3, 4, 5, 6)}
+        fast = api.dumps(value)
+        orjson, api.orjson = api.orjson, None
+        try:
+            self.assertEqual(api.dumps(value), fast)
+        finally:
+            api.orjson = orjson
+
+    def test_api_async_reads(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        uri = f"sqlite:///{tmp}/async.db"
+        engine = create_engine(uri)
+        db.metadata.create_all(engine)
+        with Session(engine) as session:
+            viewer = User(id=self.testuser.id, username='viewer', email='viewer@test.com',
+                          password='x')
+            author = User(username='author', email='author@test.com', password='x')
+            session.add_all([viewer, author])
+            session.flush()
+            session.add_all([Message(text=f'async {i}', user_id=author.id,
+                                     timestamp=datetime(2023, 1, 1 + i)) for i in range(3)])
+            session.commit()
+            author_id = author.id
+        engine.dispose()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            cookie = client.get_cookie('session').value
+
+        def call(path, query='', headers=(), signed_in=True):
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                messages.append(message)
+
+            async def run():
+                reads = AsyncReads(app, create_async_engine(async_url(uri)))
+                scope = {'type': 'http', 'method': 'GET', 'path': path, 'raw_path': path.encode(),
+                         'root_path': '', 'scheme': 'http', 'query_string': query.encode(),
+                         'headers': [*([(b'cookie', f'session={cookie}'.encode())]
+                                       if signed_in else []), *headers],
+                         'server': ('localhost', 80), 'client': ('127.0.0.1', 1234),
+                         'http_version': '1.1', 'asgi': {'version': '3.0'}}
+                await reads(scope, receive, send)
+                await reads.engine.dispose()
+
+            asyncio.run(run())
+            body = b''.join(m.get('body', b'') for m in messages if m['type'] == 'http.response.body')
+            return messages[0]['status'], body
+
+        self.assertEqual(async_url('postgresql://u@h/db').drivername, 'postgresql+asyncpg')
+
+        status, body = call(f'/api/v1/users/{author_id}/messages', 'limit=2')
+        self.assertEqual(status, 200)
+        page = json.loads(body)
+        self.assertEqual([item['text'] for item in page['items']], ['async 2', 'async 1'])
+        self.assertEqual(page['items'][0]['timestamp'], '2023-01-03T00:00:00')
+
+        status, body = call(f'/api/v1/users/{author_id}/messages',
+                            f'limit=2&before={page["next_cursor"]}')
+        self.assertEqual([item['text'] for item in json.loads(body)['items']], ['async 0'])
+
+        status, body = call(f'/api/v1/users/{author_id}/messages',
+                            headers=[(b'accept', b'application/x-ndjson')])
+        self.assertEqual(len(body.splitlines()), 3)
+
+        self.assertEqual(call('/api/v1/users/0/likes')[0], 404)
+        self.assertEqual(call('/api/v1/timeline')[0], 200)
+
+        # the author blocks the viewer, as `User.block` does
+        with engine.begin() as connection:
+            connection.execute(insert(Blocking).values(blocker_id=author_id,
+                                                       blockee_id=self.testuser.id))
+            connection.execute(update(User).values(relations_version=User.relations_version + 1))
+        engine.dispose()
+        not_found = REQUESTS.labels('api.user_follows', 'GET', '404')
+        before = not_found._value.get()
+        self.assertEqual(call(f'/api/v1/users/{author_id}/messages')[0], 404)
+        self.assertEqual(call(f'/api/v1/users/{author_id}/followers')[0], 404)
+        # the metrics record the status actually sent
+        self.assertEqual(not_found._value.get(), before + 1)
+        self.assertEqual(call(f'/api/v1/users/{author_id}/followers', signed_in=False)[0], 401)
+
+        # everything else is served by Flask
+        status, body = call('/login')
+        self.assertEqual(status, 200)
+        self.assertIn(b'<form', body)
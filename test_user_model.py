@@ -6,11 +6,15 @@
 
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import FollowRequest, db, User, Message, Follows
+from models import ArchivedFollowRequest, FollowRequest, db, User, Message, Follows, TimelineEntry
 from sqlalchemy.exc import IntegrityError
+from flask import Flask
 from flask_bcrypt import Bcrypt
+from libs.credentials import CredentialVerifier, VerifierSaturated, hash_cost
+from libs.query_stats import query_budget
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
@@ -334,3 +338,192 @@ class UserModelTestCase(TestCase):
 
 
 
+    def test_home_timeline_fan_out(self):
+        with app.app_context():
+            author = User(username='author', email='author@gmail.com', password='HASHED_PASSWORD')
+            reader = User(username='reader', email='reader@gmail.com', password='HASHED_PASSWORD')
+            db.session.add_all([author, reader])
+            db.session.commit()
+
+            old = Message(text='before follow', user_id=author.id)
+            db.session.add(old)
+            db.session.commit()
+
+            reader.follow(author)
+            self.assertEqual(TimelineEntry.home_messages(reader), [old])
+
+            new = Message(text='after follow', user_id=author.id)
+            db.session.add(new)
+            db.session.flush()
+            TimelineEntry.fan_out(new)
+            db.session.commit()
+            self.assertEqual(TimelineEntry.home_messages(reader), [new, old])
+            self.assertEqual(TimelineEntry.home_messages(author), [new])
+
+            reader.unfollow(author)
+            self.assertEqual(TimelineEntry.home_messages(reader), [])
+
+    def test_home_timeline_pull_author(self):
+        with app.app_context():
+            app.config['TIMELINE_FANOUT_LIMIT'] = 1
+            try:
+                author = User(username='author', email='author@gmail.com', password='HASHED_PASSWORD')
+                reader = User(username='reader', email='reader@gmail.com', password='HASHED_PASSWORD')
+                db.session.add_all([author, reader])
+                db.session.commit()
+                reader.follow(author)
+
+                message = Message(text='popular', user_id=author.id)
+                db.session.add(message)
+                db.session.flush()
+                TimelineEntry.fan_out(message)
+                db.session.commit()
+
+                self.assertTrue(author.timeline_pull)
+                self.assertEqual(
+                    db.session.query(TimelineEntry).filter_by(user_id=reader.id).count(), 0)
+                self.assertEqual(TimelineEntry.home_messages(reader)[0], message)
+            finally:
+                app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+
+    def test_rebuild_timelines_like_a_backfill(self):
+        with app.app_context():
+            author = User(username='author', email='author@gmail.com', password='HASHED_PASSWORD')
+            reader = User(username='reader', email='reader@gmail.com', password='HASHED_PASSWORD')
+            db.session.add_all([author, reader])
+            db.session.commit()
+            messages = [Message(text=f'message {i}', user_id=author.id,
+                                timestamp=datetime(2023, 1, 1 + i)) for i in range(3)]
+            db.session.add_all(messages)
+            reader.following.append(author)
+            db.session.commit()
+
+            size, TimelineEntry.BACKFILL_SIZE = TimelineEntry.BACKFILL_SIZE, 2
+            try:
+                User.reconcile_counts()
+                TimelineEntry.rebuild()
+                db.session.commit()
+            finally:
+                TimelineEntry.BACKFILL_SIZE = size
+            self.assertEqual(TimelineEntry.home_messages(reader), messages[:0:-1])
+            self.assertEqual(TimelineEntry.home_messages(author), messages[::-1])
+
+    def test_counters(self):
+        with app.app_context():
+            user1 = User(username='test1', email='test1@gmail.com', password='HASHED_PASSWORD')
+            user2 = User(username='test2', email='test2@gmail.com', password='HASHED_PASSWORD')
+            db.session.add_all([user1, user2])
+            db.session.commit()
+
+            user1.follow(user2)
+            self.assertEqual((user1.following_count, user2.followers_count), (1, 1))
+            user1.unfollow(user2)
+            self.assertEqual((user1.following_count, user2.followers_count), (0, 0))
+
+            user2.following.append(user1)
+            db.session.add(Message(text='hello', user_id=user1.id))
+            db.session.commit()
+            User.reconcile_counts()
+            db.session.commit()
+            db.session.refresh(user1)
+            self.assertEqual(user1.followers_count, 1)
+            self.assertEqual(user1.messages_count, 1)
+            self.assertEqual(user1.following_count, 0)
+
+    def test_follow_request_counts_and_archive(self):
+        with app.app_context():
+            private_user = User(username='test1', email='test1@gmail.com',
+                                password='HASHED_PASSWORD', is_private=True)
+            requesters = [User(username=f'req{i}', email=f'req{i}@gmail.com',
+                               password='HASHED_PASSWORD') for i in range(3)]
+            db.session.add_all([private_user, *requesters])
+            db.session.commit()
+
+            for requester in requesters:
+                requester.follow(private_user)
+            # a repeated request while one is pending is ignored
+            self.assertTrue(requesters[0].follow(private_user))
+            self.assertEqual(FollowRequest.query.count(), 3)
+            self.assertEqual(private_user.pending_requests_count, 3)
+            self.assertEqual(requesters[0].awaiting_requests_count, 1)
+
+            page = FollowRequest.received(private_user.id, 2)
+            self.assertEqual([req.requester for req in page], requesters[:0:-1])
+            rest = FollowRequest.received(private_user.id, 2, before_id=page[-1].id)
+            self.assertEqual([req.requester for req in rest], requesters[:1])
+            self.assertEqual(len(FollowRequest.sent(requesters[0].id, 10)), 1)
+
+            self.assertTrue(private_user.accept_request(rest[0].id))
+            self.assertFalse(private_user.accept_request(rest[0].id))
+            self.assertTrue(private_user.deny_request(page[0].id))
+            self.assertTrue(requesters[1].cancel_request(page[1].id))
+            self.assertEqual(private_user.pending_requests_count, 0)
+            self.assertEqual(requesters[0].awaiting_requests_count, 0)
+            self.assertEqual(private_user.followers_count, 1)
+            self.assertEqual(FollowRequest.received(private_user.id, 10), [])
+
+            # a denied user may ask again
+            requesters[2].follow(private_user)
+            self.assertEqual(private_user.pending_requests_count, 1)
+
+            User.adjust_counts(private_user.id, pending_requests_count=5)
+            User.reconcile_counts()
+            db.session.commit()
+            self.assertEqual(private_user.pending_requests_count, 1)
+
+            self.assertEqual(FollowRequest.archive_resolved(datetime(2000, 1, 1)), 0)
+            moved = FollowRequest.archive_resolved(datetime.utcnow() + timedelta(days=1),
+                                                   batch_size=2)
+            self.assertEqual(moved, 3)
+            self.assertEqual([req.status for req in FollowRequest.query], ['pending'])
+            self.assertEqual(sorted(req.status for req in ArchivedFollowRequest.query),
+                             ['accepted', 'canceled', 'denied'])
+
+    def test_is_following_lookups(self):
+        with app.app_context():
+            user1 = User(username='test1', email='test1@gmail.com', password='HASHED_PASSWORD')
+            user2 = User(username='test2', email='test2@gmail.com', password='HASHED_PASSWORD')
+            user3 = User(username='test3', email='test3@gmail.com', password='HASHED_PASSWORD')
+            db.session.add_all([user1, user2, user3])
+            db.session.commit()
+            with query_budget(10) as stats:
+                user1.follow(user2)
+            # the follow lists themselves are never loaded
+            self.assertFalse([s for s in stats.executed if 'FROM users, follows' in s])
+
+            self.assertTrue(user1.is_following(user2))
+            self.assertTrue(user2.is_followed_by(user1))
+            self.assertFalse(user2.is_following(user1))
+            self.assertEqual(
+                User.followed_among(user1.id, [user2.id, user3.id]), {user2.id})
+
+            with query_budget(10) as stats:
+                user1.unfollow(user2)
+            self.assertFalse([s for s in stats.executed if 'FROM users, follows' in s])
+            self.assertFalse(user1.is_following(user2))
+
+    def test_authenticate_upgrades_hash_cost(self):
+        with app.app_context():
+            weak_hash = Bcrypt()
+            weak_hash._log_rounds = 4
+            user = User(
+                email='demo@gmail.com',
+                username='demo',
+                password=weak_hash.generate_password_hash('123123').decode('utf-8')
+            )
+            db.session.add(user)
+            db.session.commit()
+
+            self.assertEqual(User.authenticate('demo', '123123'), user)
+            self.assertEqual(hash_cost(user.password), app.config['BCRYPT_LOG_ROUNDS'])
+            self.assertEqual(User.authenticate('demo', '123123'), user)
+
+    def test_credential_verifier_fails_fast_when_saturated(self):
+        verifier = CredentialVerifier()
+        verifier.init_app(Flask(__name__))
+        pw_hash = bcrypt.generate_password_hash('123123').decode('utf-8')
+        for _ in range(verifier.limit):
+            verifier._slots.acquire()
+        self.assertRaises(VerifierSaturated, verifier.check, pw_hash, '123123')
+        verifier._slots.release()
+        self.assertTrue(verifier.check(pw_hash, '123123'))
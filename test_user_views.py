@@ -1,13 +1,26 @@
+import os
+import shutil
+import tempfile
+import threading
 from unittest import TestCase
 
+from flask import Flask, redirect, request
 from flask.testing import FlaskClient
-from models import db, User 
+from sqlalchemy import insert, select, update
+from models import db, Blocking, FollowRequest, Follows, Message, TimelineEntry, User 
 from os import environ
 environ['DATABASE_URL'] = 'sqlite:///:memory:'
 from app import app, CURR_USER_KEY
 from flask import session, g
 from flask_bcrypt import Bcrypt
 from bs4 import BeautifulSoup
+from libs.user_snapshot import SNAPSHOT_KEY, profile_versions
+from libs.username_index import username_index
+from libs.query_stats import query_budget
+from libs.profiler import SamplingProfiler, profiler
+from libs.replicas import PRIMARY_UNTIL_KEY, init_engines, read_replica
+from libs.block_filter import block_filter
+from libs.credentials import credentials
 
 with app.app_context():
   db.create_all()
@@ -17,7 +30,10 @@ bcrypt = Bcrypt(app)
 class UserViewTest(TestCase):
   def setUp(self) -> None:
     with app.app_context():
-      User.query.delete()
+      block_filter.clear()
+      profile_versions.clear()
+      for model in (Blocking, FollowRequest, Follows, TimelineEntry, Message, User):
+        model.query.delete()
       user = User(
         username='testuser',
         email='test@test.com',
@@ -58,3 +74,365 @@ class UserViewTest(TestCase):
       res = client.get(f'/users/{self.user_id}/followers', follow_redirects=True)
       self.assertEqual(res.status_code, 401)
 
+
+  def test_user_snapshot_refreshed_on_write(self):
+    with app.test_client() as client:
+      client.post('/login', data={'username': 'testuser', 'password': '123123'})
+      self.assertEqual(session[SNAPSHOT_KEY][:2], [self.user_id, 'testuser'])
+      self.assertFalse(session[SNAPSHOT_KEY][4])
+
+      client.post(f'/users/{self.user_id}/change-status', data={'is_private': 'true'})
+      self.assertTrue(session[SNAPSHOT_KEY][4])
+
+      client.get('/logout')
+      self.assertNotIn(SNAPSHOT_KEY, session)
+
+  def test_user_snapshot_refreshed_in_other_sessions(self):
+    phone, laptop = app.test_client(), app.test_client()
+    phone.post('/login', data={'username': 'testuser', 'password': '123123'})
+    laptop.post('/login', data={'username': 'testuser', 'password': '123123'})
+
+    phone.post(f'/users/{self.user_id}/change-status', data={'is_private': 'true'})
+    laptop.get('/')
+    with laptop.session_transaction() as sess:
+      self.assertTrue(sess[SNAPSHOT_KEY][4])
+
+    phone.post('/users/delete')
+    laptop.get('/')
+    with laptop.session_transaction() as sess:
+      self.assertNotIn(CURR_USER_KEY, sess)
+      self.assertNotIn(SNAPSHOT_KEY, sess)
+
+  def test_profile_version_checked_once_per_ttl(self):
+    with app.test_client() as client:
+      self.login(client)
+      client.get('/')
+      self.assertEqual(client.get('/static/stylesheets/style.css').headers['X-DB-Queries'], '0')
+
+      # a profile change committed by another worker
+      with app.app_context():
+        db.session.execute(update(User).where(User.id == self.user_id)
+                           .values(is_private=True, profile_version=User.profile_version + 1))
+        db.session.commit()
+      client.get('/')
+      with client.session_transaction() as sess:
+        self.assertFalse(sess[SNAPSHOT_KEY][4])
+
+      ttl, profile_versions.ttl = profile_versions.ttl, 0
+      try:
+        client.get('/')
+      finally:
+        profile_versions.ttl = ttl
+      with client.session_transaction() as sess:
+        self.assertTrue(sess[SNAPSHOT_KEY][4])
+
+  def test_username_search(self):
+    with app.app_context():
+      db.session.add(User(username='another', email='another@test.com', password='HASHED_PASSWORD'))
+      db.session.commit()
+      username_index.warm()
+
+    with app.test_client() as client:
+      res = client.get('/users/typeahead?q=TES')
+      self.assertEqual(res.json, [{'id': self.user_id, 'username': 'testuser'}])
+
+      html = client.get('/users?q=an').get_data(as_text=True)
+      self.assertIn('@another', html)
+      self.assertNotIn('@testuser', html)
+
+      html = client.get('/users?q=%25').get_data(as_text=True)
+      self.assertIn('Sorry, no users found', html)
+
+  def test_username_index_catches_up_below_local_signups(self):
+    with app.app_context():
+      username_index.warm()
+      elsewhere = User(username='elsewhere', email='elsewhere@test.com', password='HASHED_PASSWORD')
+      db.session.add(elsewhere)
+      db.session.commit()
+      # a later signup handled by this worker
+      local = User(username='local', email='local@test.com', password='HASHED_PASSWORD')
+      db.session.add(local)
+      db.session.commit()
+      username_index.add(local.id, local.username)
+
+      ttl, username_index.ttl = username_index.ttl, 0
+      try:
+        self.assertEqual([name for _, name in username_index.search('elsewhere')], ['elsewhere'])
+      finally:
+        username_index.ttl = ttl
+
+  def test_follow_pages_query_budget(self):
+    with app.app_context():
+      me = db.session.get(User, self.user_id)
+      for i in range(5):
+        other = User(username=f'other{i}', email=f'other{i}@test.com', password='HASHED_PASSWORD')
+        db.session.add(other)
+        db.session.commit()
+        me.follow(other)
+        other.follow(me)
+
+    with app.test_client() as client:
+      self.login(client)
+      with query_budget(8):
+        self.assertEqual(client.get(f'/users/{self.user_id}/followers').status_code, 200)
+      with query_budget(8):
+        self.assertEqual(client.get(f'/users/{self.user_id}/following').status_code, 200)
+
+  def test_metrics_endpoint(self):
+    with app.test_client() as client:
+      self.login(client)
+      client.get(f'/users/{self.user_id}/followers')
+      self.assertEqual(client.get('/metrics').status_code, 404)
+      app.config['METRICS_TOKEN'] = 'scraper-secret'
+      try:
+        self.assertEqual(client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 404)
+        text = client.get('/metrics', headers={'Authorization': 'Bearer scraper-secret'}).get_data(as_text=True)
+      finally:
+        app.config['METRICS_TOKEN'] = None
+      self.assertIn('warbler_request_duration_seconds_count{endpoint="users_followers"}', text)
+      self.assertIn('warbler_requests_total{endpoint="users_followers",method="GET",status="200"}', text)
+      self.assertIn('warbler_template_render_seconds_count{template="users/followers.html"}', text)
+      self.assertIn('warbler_requests_in_flight', text)
+
+  def test_profile_capture_is_admin_only(self):
+    directory = tempfile.mkdtemp()
+    app.config['ADMIN_USERNAMES'] = {'testuser'}
+    profiler.directory = directory
+    try:
+      with app.test_client() as client:
+        self.assertEqual(client.post('/admin/profile').status_code, 401)
+        self.login(client)
+        res = client.post('/admin/profile', data={'seconds': 5})
+        self.assertEqual(res.status_code, 200)
+
+        # another worker sharing the directory sees the capture
+        worker = SamplingProfiler()
+        worker.directory = directory
+        self.assertTrue(worker.capturing())
+
+        app.config['ADMIN_USERNAMES'] = set()
+        self.assertEqual(client.post('/admin/profile').status_code, 403)
+    finally:
+      profiler.directory = None
+      app.config['ADMIN_USERNAMES'] = set()
+      shutil.rmtree(directory)
+
+  def test_profiler_switched_off_stops_capture_checks(self):
+    directory = tempfile.mkdtemp()
+    worker = SamplingProfiler()
+    worker.directory = directory
+    try:
+      worker.trigger(5)
+      self.assertTrue(worker.capturing())
+      # a sampler thread started earlier can still check after it is turned off
+      worker.directory = None
+      worker._capture_checked = 0
+      self.assertFalse(worker.capturing())
+    finally:
+      shutil.rmtree(directory)
+
+  def test_profiler_sampler_idles_between_requests(self):
+    directory = tempfile.mkdtemp()
+    profiler_app = Flask(__name__)
+    profiler_app.config.update(PROFILE_DIR=directory, PROFILE_ENDPOINTS={'index'})
+    worker = SamplingProfiler(profiler_app)
+    seen = []
+
+    @profiler_app.route('/')
+    def index():
+      seen.append(worker._busy.is_set())
+      return 'ok'
+
+    try:
+      self.assertEqual(profiler_app.test_client().get('/').status_code, 200)
+      self.assertEqual(seen, [True])
+      self.assertFalse(worker._busy.is_set())
+      self.assertEqual(worker._active, {})
+    finally:
+      shutil.rmtree(directory)
+
+  def test_profiler_writes_collapsed_stacks(self):
+    directory = tempfile.mkdtemp()
+    worker = SamplingProfiler()
+    worker.directory, worker.keep = directory, 1
+    try:
+      worker._active[threading.get_ident()] = 'homepage'
+      worker.sample()
+      worker.flush()
+      worker.sample()
+      path = worker.flush()
+      self.assertEqual(os.listdir(directory), [os.path.basename(path)])
+      with open(path) as profile:
+        stack, count = profile.read().rsplit(' ', 1)
+      self.assertTrue(stack.startswith('homepage;'))
+      self.assertIn('test_profiler_writes_collapsed_stacks (test_user_views.py:', stack)
+      self.assertEqual(count.strip(), '1')
+    finally:
+      shutil.rmtree(directory)
+
+  def test_read_replica_routing(self):
+    directory = tempfile.mkdtemp()
+    replica_app = Flask(__name__)
+    replica_app.config.update(
+      SECRET_KEY='replicas',
+      SQLALCHEMY_DATABASE_URI=f'sqlite:///{directory}/primary.db',
+      SQLALCHEMY_REPLICA_URIS=[f'sqlite:///{directory}/replica.db'],
+      REPLICA_STICKY_SECONDS=60)
+    init_engines(replica_app)
+    db.init_app(replica_app)
+
+    @replica_app.get('/usernames')
+    @read_replica()
+    def usernames():
+      return ','.join(db.session.scalars(select(User.username).order_by(User.id)))
+
+    @replica_app.post('/usernames')
+    def add_username():
+      username = request.form['username']
+      db.session.add(User(username=username, email=f'{username}@test.com', password='x'))
+      db.session.commit()
+      return redirect('/usernames')
+
+    try:
+      with replica_app.app_context():
+        db.create_all()
+        replica = db.engines['replica_0']
+        db.metadata.create_all(replica)
+        with replica.begin() as conn:
+          conn.execute(insert(User).values(username='replicated', email='r@test.com', password='x'))
+
+      with replica_app.test_client() as client:
+        self.assertEqual(client.get('/usernames').text, 'replicated')
+        # the write goes to the primary and the redirect reads it back from there
+        res = client.post('/usernames', data={'username': 'fresh'}, follow_redirects=True)
+        self.assertEqual(res.text, 'fresh')
+        self.assertEqual(client.get('/usernames').text, 'fresh')
+
+        with client.session_transaction() as sess:
+          sess[PRIMARY_UNTIL_KEY] = 0
+        self.assertEqual(client.get('/usernames').text, 'replicated')
+    finally:
+      with replica_app.app_context():
+        for engine in db.engines.values():
+          engine.dispose()
+      shutil.rmtree(directory)
+
+  def test_blocks_filter_timeline_and_follow_pages(self):
+    with app.app_context():
+      author = User(username='author', email='author@test.com', password='x')
+      db.session.add(author)
+      db.session.commit()
+      author_id = author.id
+      me = db.session.get(User, self.user_id)
+      me.follow(author)
+      db.session.commit()
+
+    with app.test_client() as client:
+      with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = author_id
+      client.post('/messages/new', data={'text': 'you will not see this'})
+
+      self.login(client)
+      self.assertIn('you will not see this', client.get('/').text)
+      self.assertIn('@author', client.get(f'/users/{self.user_id}/following').text)
+
+      client.post(f'/users/{author_id}/block')
+      self.assertNotIn('you will not see this', client.get('/').text)
+      html = client.get(f'/users/{author_id}').text
+      self.assertIn('Unblock', html)
+      self.assertIn("You can't see this user's messages", html)
+      self.assertNotIn('@author</p>', client.get(f'/users/{self.user_id}/following').text)
+      self.assertNotIn('you will not see this', client.get('/messages/search?q=see').text)
+      with app.app_context():
+        message_id = db.session.scalar(select(Message.id).where(Message.user_id == author_id))
+      self.assertEqual(client.get(f'/messages/{message_id}').status_code, 404)
+
+      client.post(f'/users/{author_id}/unblock')
+      self.assertIn('you will not see this', client.get('/').text)
+      self.assertIn('you will not see this', client.get('/messages/search?q=see').text)
+
+  def test_follow_request_inbox(self):
+    with app.app_context():
+      me = db.session.get(User, self.user_id)
+      me.is_private = True
+      db.session.commit()
+      for i in range(3):
+        other = User(username=f'asker{i}', email=f'asker{i}@test.com', password='x')
+        db.session.add(other)
+        db.session.commit()
+        other.follow(me)
+      denied = FollowRequest.query.order_by(FollowRequest.id).first()
+      me.deny_request(denied.id)
+
+    app.config['FOLLOW_REQUESTS_PAGE_SIZE'] = 1
+    try:
+      with app.test_client() as client:
+        self.login(client)
+        html = client.get(f'/users/{self.user_id}/followers').text
+        soup = BeautifulSoup(html, 'html.parser')
+        self.assertEqual(soup.select_one('span.badge span').text, '2')
+        self.assertIn('@asker2', html)
+        self.assertNotIn('@asker1', html)
+        more = soup.find('a', string='More requests')['href']
+        html = client.get(more).text
+        self.assertIn('@asker1', html)
+        self.assertNotIn('@asker0', html)
+        self.assertIsNone(BeautifulSoup(html, 'html.parser').find('a', string='More requests'))
+    finally:
+      app.config['FOLLOW_REQUESTS_PAGE_SIZE'] = 20
+
+  def test_deleting_user_clears_their_follow_requests(self):
+    with app.app_context():
+      me = db.session.get(User, self.user_id)
+      wanted = User(username='wanted', email='wanted@test.com', password='x', is_private=True)
+      asker = User(username='asker', email='asker@test.com', password='x')
+      me.is_private = True
+      db.session.add_all([wanted, asker])
+      db.session.commit()
+      wanted_id, asker_id = wanted.id, asker.id
+      me.follow(wanted)
+      asker.follow(me)
+      versions = {user.id: user.relations_version for user in (wanted, asker)}
+
+    with app.test_client() as client:
+      self.login(client)
+      client.post('/users/delete')
+
+    with app.app_context():
+      wanted = db.session.get(User, wanted_id)
+      asker = db.session.get(User, asker_id)
+      self.assertEqual(wanted.pending_requests_count, 0)
+      self.assertEqual(asker.awaiting_requests_count, 0)
+      self.assertGreater(wanted.relations_version, versions[wanted_id])
+      self.assertGreater(asker.relations_version, versions[asker_id])
+
+  def test_concurrent_logins_beyond_limit_get_503(self):
+    with app.app_context():
+      user = db.session.get(User, self.user_id)
+      # slow enough that all logins below overlap
+      user.password = bcrypt.generate_password_hash('123123', 14).decode('utf-8')
+      db.session.commit()
+
+    saved = {key: app.config[key] for key in ('CREDENTIAL_WORKERS', 'CREDENTIAL_QUEUE_SIZE')}
+    app.config.update(CREDENTIAL_WORKERS=1, CREDENTIAL_QUEUE_SIZE=1)
+    credentials.init_app(app)
+    start = threading.Barrier(4)
+    statuses = []
+
+    def login():
+      with app.test_client() as client:
+        start.wait()
+        resp = client.post('/login', data={'username': 'testuser', 'password': 'wrong-password'})
+        statuses.append(resp.status_code)
+
+    try:
+      threads = [threading.Thread(target=login) for _ in range(4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    finally:
+      app.config.update(saved)
+      credentials.init_app(app)
+
+    self.assertEqual(sorted(statuses), [200, 200, 503, 503])